@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmarks.hotpaths
+    ~~~~~~~~~~~~~~~~~~~
+
+    Measures the throughput and allocations of the hot paths of the payment
+    client: building and encoding payment JSON, validating receipts and
+    creating payments against a local stub server.
+
+    Run with ``python benchmarks/hotpaths.py [name-filter ...]``.
+"""
+import json
+import os
+import sys
+import threading
+import time
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2
+    tracemalloc = None
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from verkkomaksut import (
+    Client,
+    Contact,
+    HistogramRecorder,
+    Payment,
+    PaymentTemplate,
+    Product
+)
+from verkkomaksut.testing import StubServer
+
+
+def make_payment(products):
+    payment = Payment(
+        order_number='12345678',
+        contact=Contact(
+            first_name='Matti',
+            last_name='Meikäläinen',
+            email='matti.meikalainen@gmail.com',
+            street='Esimerkkikatu 123',
+            postal_code='01234',
+            postal_office='Helsinki',
+            country='FI'
+        ),
+        success_url='https://www.esimerkkikauppa.fi/sv/success',
+        failure_url='https://www.esimerkkikauppa.fi/sv/failure',
+        notification_url='https://www.esimerkkikauppa.fi/sv/success'
+    )
+    for n in range(products):
+        payment.products.append(
+            Product(title='Tuote %d' % n, price='19.90', vat='23.00')
+        )
+    return payment
+
+
+def bench(name, func, min_time=0.2, repeat=3):
+    """Runs `func` repeatedly and prints the best throughput of `repeat`
+    rounds together with the memory allocated by a single call."""
+    func()
+    loops = 1
+    while True:
+        start = time.time()
+        for _ in range(loops):
+            func()
+        elapsed = time.time() - start
+        if elapsed >= min_time:
+            break
+        loops *= 2
+    best = elapsed
+    for _ in range(repeat - 1):
+        start = time.time()
+        for _ in range(loops):
+            func()
+        best = min(best, time.time() - start)
+
+    if tracemalloc is not None:
+        tracemalloc.start()
+        func()
+        allocated = '%.1f' % (tracemalloc.get_traced_memory()[1] / 1024.0)
+        tracemalloc.stop()
+    else:
+        allocated = 'n/a'
+    print('%-44s %14.0f %12.1f %12s' % (
+        name, loops / best, 1e6 * best / loops, allocated
+    ))
+
+
+def payment_benchmarks():
+    for products in (1, 50, 500):
+        payment = make_payment(products)
+        data = payment.json
+        yield 'Payment.json build (%d products)' % products, \
+            lambda payment=payment: payment.json
+        yield 'Payment.encode cached (%d products)' % products, \
+            lambda payment=payment: payment.encode()
+        yield 'json.dumps payload (%d products)' % products, \
+            lambda data=data: json.dumps(data)
+
+
+def template_benchmarks():
+    template = PaymentTemplate(
+        success_url='https://www.esimerkkikauppa.fi/sv/success',
+        failure_url='https://www.esimerkkikauppa.fi/sv/failure',
+        notification_url='https://www.esimerkkikauppa.fi/sv/success'
+    )
+    for products in (1, 50):
+        regular = make_payment(products)
+        payment = template.payment(
+            regular.order_number, regular.contact, regular.products
+        )
+
+        def encode_regular(payment=regular):
+            for model in [payment, payment.contact] + list(payment.products):
+                object.__setattr__(model, '_cache', None)
+            return payment.encode()
+
+        def encode_template(payment=payment):
+            for model in [payment.contact] + list(payment.products):
+                object.__setattr__(model, '_cache', None)
+            payment.__dict__.pop('_template_cache', None)
+            return payment.encode()
+
+        yield 'Payment.encode uncached (%d products)' % products, \
+            encode_regular
+        yield 'PaymentTemplate encode (%d products)' % products, \
+            encode_template
+
+
+def validation_benchmarks():
+    client = Client()
+    params = ('12345678', '1176557554', '0123456789', '1')
+    success = client._calculate_payment_receipt_hash(*params)
+    failure = client._calculate_payment_receipt_hash(*params[:2])
+    yield 'validate_successful_payment', \
+        lambda: client.validate_successful_payment(success, *params)
+    yield 'validate_failed_payment', \
+        lambda: client.validate_failed_payment(failure, *params[:2])
+
+
+def create_payment_benchmarks():
+    server = StubServer().start()
+    client = Client()
+    client.SERVICE_URL = server.service_url
+    measured = Client(metrics=HistogramRecorder())
+    measured.SERVICE_URL = server.service_url
+    try:
+        for products in (1, 500):
+            payment = make_payment(products)
+            yield 'create_payment round trip (%d products)' % products, \
+                lambda payment=payment: client.create_payment(payment)
+        payment = make_payment(1)
+        yield 'create_payment with metrics (1 products)', \
+            lambda: measured.create_payment(payment)
+    finally:
+        client.session.close()
+        measured.session.close()
+        server.stop()
+
+
+def concurrency_benchmarks():
+    server = StubServer(latency=0.02).start()
+    client = Client(pool_maxsize=8)
+    client.SERVICE_URL = server.service_url
+    payment = make_payment(1)
+
+    def sequential():
+        for _ in range(8):
+            client.create_payment(payment)
+
+    def threaded():
+        threads = [
+            threading.Thread(target=client.create_payment, args=(payment,))
+            for _ in range(8)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    try:
+        yield 'create_payment x8 sequential (20 ms latency)', sequential
+        yield 'create_payment x8 in 8 threads (20 ms latency)', threaded
+    finally:
+        client.adapter.close()
+        server.stop()
+
+
+def main(filters):
+    print('%-44s %14s %12s %12s' % (
+        'benchmark', 'ops/sec', 'usec/op', 'KiB/op'
+    ))
+    for benchmarks in (payment_benchmarks, template_benchmarks,
+                       validation_benchmarks, create_payment_benchmarks,
+                       concurrency_benchmarks):
+        for name, func in benchmarks():
+            if not filters or any(f in name for f in filters):
+                bench(name, func)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmarks.importtime
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    Measures the cold start cost of the package: the time it takes to import
+    `verkkomaksut` and validate a receipt in a fresh interpreter, over the
+    time of starting an empty interpreter.
+
+    Run with ``python benchmarks/importtime.py [--max-ms N]``.  With
+    ``--max-ms`` the script exits with an error when the import takes longer,
+    for catching regressions in CI.  ``python -X importtime -c 'import
+    verkkomaksut'`` shows where the time goes.
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SCENARIOS = [
+    ('empty interpreter', 'pass'),
+    ('import verkkomaksut', 'import verkkomaksut'),
+    ('validate a receipt', (
+        'import verkkomaksut\n'
+        'client = verkkomaksut.Client()\n'
+        'client.validate_failed_payment("0" * 32, "12345", "1176557554")\n'
+    )),
+    ('create a session', (
+        'import verkkomaksut\n'
+        'verkkomaksut.Client().session\n'
+    )),
+]
+
+REPORT = (
+    '\nimport sys\n'
+    'sys.stderr.write("%d %d" % (len(sys.modules), "requests" in sys.modules))'
+)
+
+
+def run(code, repeat):
+    """Returns the best wall clock time of running `code` in a new
+    interpreter, the number of modules it imported and whether `requests`
+    was imported."""
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        process = subprocess.Popen(
+            [sys.executable, '-c', code + REPORT],
+            cwd=ROOT,
+            stderr=subprocess.PIPE
+        )
+        _, report = process.communicate()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    modules, requests = report.decode('ascii').split()
+    return best, int(modules), requests == '1'
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--max-ms', type=float, default=None,
+                        help='fail if importing takes longer than this')
+    args = parser.parse_args(argv)
+
+    print('%-24s %10s %10s %10s' % ('scenario', 'ms', 'modules', 'requests'))
+    baseline = None
+    results = {}
+    for name, code in SCENARIOS:
+        elapsed, modules, requests = run(code, args.repeat)
+        if baseline is None:
+            baseline = elapsed
+        results[name] = 1000 * (elapsed - baseline)
+        print('%-24s %10.1f %10d %10s' % (
+            name, results[name], modules, 'yes' if requests else 'no'
+        ))
+
+    if args.max_ms is not None and \
+            results['import verkkomaksut'] > args.max_ms:
+        sys.exit('importing verkkomaksut took %.1f ms, over %.1f ms' % (
+            results['import verkkomaksut'], args.max_ms
+        ))
+
+
+if __name__ == '__main__':
+    main()
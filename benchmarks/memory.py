@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmarks.memory
+    ~~~~~~~~~~~~~~~~~
+
+    Compares the memory used by the regular and the compact payment models.
+
+    Run with ``python benchmarks/memory.py``.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from verkkomaksut import (
+    CompactContact,
+    CompactPayment,
+    CompactProduct,
+    Contact,
+    Payment,
+    Product
+)
+
+
+def sizeof(obj):
+    """Returns the size of a model, its instance dictionary and its nested
+    models in bytes.  The field values are shared between the compared
+    objects and not counted."""
+    size = sys.getsizeof(obj)
+    if hasattr(obj, '__dict__'):
+        size += sys.getsizeof(obj.__dict__)
+    if isinstance(obj, (Payment, CompactPayment)):
+        size += sizeof(obj.contact) + sys.getsizeof(obj.products)
+        size += sum(sizeof(product) for product in obj.products)
+    return size
+
+
+def measure(factory, count=1000):
+    """Returns the average number of bytes allocated by one call of
+    `factory`.  `tracemalloc` is used when available; otherwise the objects
+    are measured with `sys.getsizeof`, which ignores nested objects."""
+    try:
+        import tracemalloc
+    except ImportError:
+        return sum(sizeof(factory()) for _ in range(count)) / count
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        objects = [factory() for _ in range(count)]
+        after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    del objects
+    return (after - before) // count
+
+
+CONTACT = dict(
+    first_name='Matti',
+    last_name='Meikäläinen',
+    email='matti.meikalainen@gmail.com',
+    street='Esimerkkikatu 123',
+    postal_code='01234',
+    postal_office='Helsinki',
+    country='FI'
+)
+
+URLS = dict(
+    success_url='https://www.esimerkkikauppa.fi/sv/success',
+    failure_url='https://www.esimerkkikauppa.fi/sv/failure',
+    notification_url='https://www.esimerkkikauppa.fi/sv/success'
+)
+
+TITLES = ['Tuote %d' % n for n in range(500)]
+
+
+def make_payment(payment_class, contact_class, product_class, products):
+    payment = payment_class(
+        order_number='12345678', contact=contact_class(**CONTACT), **URLS
+    )
+    payment.products.extend(
+        product_class(title=title, price='19.90', vat='23.00')
+        for title in TITLES[:products]
+    )
+    return payment
+
+
+def main():
+    regular = (Payment, Contact, Product)
+    compact = (CompactPayment, CompactContact, CompactProduct)
+    benchmarks = [
+        ('Contact', 1000, lambda models: models[1](**CONTACT)),
+        ('Product', 1000, lambda models: models[2](
+            title='Tuote', price='19.90', vat='23.00'
+        )),
+        ('Payment (1 product)', 1000,
+         lambda models: make_payment(*(models + (1,)))),
+        ('Payment (500 products)', 20,
+         lambda models: make_payment(*(models + (500,)))),
+    ]
+
+    print('%-24s %12s %12s %8s' % ('object', 'regular', 'compact', 'saved'))
+    for name, count, factory in benchmarks:
+        regular_size = measure(lambda: factory(regular), count)
+        compact_size = measure(lambda: factory(compact), count)
+        print('%-24s %12d %12d %7.0f%%' % (
+            name, regular_size, compact_size,
+            100.0 * (regular_size - compact_size) / regular_size
+        ))
+
+
+if __name__ == '__main__':
+    main()
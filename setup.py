@@ -47,6 +47,9 @@ setup(
     install_requires=[
         'requests',
     ],
+    extras_require={
+        'async': ['aiohttp'],
+    },
     classifiers=[
         'Development Status :: 4 - Beta',
         'Intended Audience :: Developers',
@@ -8,16 +8,67 @@
     :copyright: (c) 2012 by Janne Vanhala.
     :license: BSD, see LICENSE for more details.
 """
+import copy
+import io
+import json
+import os
+import pickle
+import subprocess
+import sys
+import threading
+import time
+from decimal import Decimal
+
+try:
+    from queue import Full
+except ImportError:  # Python 2
+    from Queue import Full
+
+try:
+    from urllib.parse import urlencode
+except ImportError:  # Python 2
+    from urllib import urlencode
+
+import pytest
 import requests
 from flexmock import flexmock
 from pytest import raises
 from verkkomaksut import (
+    CircuitBreaker,
     Client,
+    ClientRegistry,
+    CompactContact,
+    CompactPayment,
+    CompactProduct,
     Contact,
+    ContactCache,
+    FileRateLimiter,
+    HistogramRecorder,
+    JSONCodec,
     Payment,
+    PaymentResult,
+    PaymentTemplate,
     Product,
+    ProductList,
+    ProductTable,
+    RateLimiter,
+    Receipt,
+    ReceiptValidator,
+    RequestMetrics,
+    RetryPolicy,
     VerkkomaksutException
 )
+from verkkomaksut.importer import (
+    build_payments,
+    import_payments,
+    read_csv,
+    read_json_lines
+)
+from verkkomaksut.metrics import Histogram
+from verkkomaksut.middleware import ReceiptMiddleware
+from verkkomaksut.notifications import NotificationPipeline
+from verkkomaksut.replay import MemoryReplayCache, SQLiteReplayCache
+from verkkomaksut.testing import StubServer
 
 
 class TestVerkkomaksutException(object):
@@ -376,6 +427,546 @@ class TestPaymentWithAllParameters(object):
         }
 
 
+class TestPaymentJsonCaching(object):
+    def setup_method(self, method):
+        self.contact = Contact(
+            first_name='Matti',
+            last_name='Meikäläinen',
+            email='matti.meikalainen@gmail.com',
+            street='Esimerkkikatu 123',
+            postal_code='01234',
+            postal_office='Helsinki',
+            country='FI'
+        )
+        self.product = Product(title='Esimerkkituote', price='19.90', vat=23)
+        self.payment = Payment(
+            order_number='12345678',
+            contact=self.contact,
+            success_url='https://www.esimerkkikauppa.fi/sv/success',
+            failure_url='https://www.esimerkkikauppa.fi/sv/failure',
+            notification_url='https://www.esimerkkikauppa.fi/sv/success'
+        )
+        self.payment.products.append(self.product)
+
+    def test_json_can_be_modified(self):
+        encoded = self.payment.encode()
+        data = self.payment.json
+        assert data is not self.payment.json
+        data['orderNumber'] = '87654321'
+        data['orderDetails']['products'].pop()
+        assert self.payment.json['orderNumber'] == '12345678'
+        assert self.payment.encode() is encoded
+
+    def test_encoded_json_is_cached(self):
+        encoded = self.payment.encode()
+        assert encoded == json.dumps(self.payment.json)
+        assert self.payment.encode() is encoded
+
+    def test_setting_field_invalidates_cache(self):
+        encoded = self.payment.encode()
+        self.payment.order_number = '12345678'
+        assert self.payment.encode() is not encoded
+        assert self.payment.encode() == encoded
+
+    def test_setting_equal_value_of_other_type_invalidates_cache(self):
+        self.payment.encode()
+        self.product.vat = 23.0
+        assert json.loads(self.payment.encode())['orderDetails'][
+            'products'][0]['vat'] == 23.0
+
+    def test_changing_payment_invalidates_cache(self):
+        encoded = self.payment.encode()
+        self.payment.order_number = '87654321'
+        assert self.payment.encode() != encoded
+        assert self.payment.json['orderNumber'] == '87654321'
+
+    def test_changing_contact_invalidates_cache(self):
+        self.payment.json
+        self.contact.street = 'Toinenkatu 1'
+        assert self.payment.json['orderDetails']['contact']['address'][
+            'street'] == 'Toinenkatu 1'
+
+    def test_changing_product_invalidates_cache(self):
+        self.payment.json
+        self.product.type = Product.TYPE_POSTAGE
+        assert self.payment.json['orderDetails']['products'][0]['type'] == 2
+
+    def test_changing_product_list_invalidates_cache(self):
+        self.payment.json
+        self.payment.products.append(Product(title='B', price='1.00', vat=23))
+        assert len(self.payment.json['orderDetails']['products']) == 2
+        del self.payment.products[:1]
+        assert len(self.payment.json['orderDetails']['products']) == 1
+        self.payment.products[0] = self.product
+        assert self.payment.json['orderDetails']['products'][0][
+            'title'] == 'Esimerkkituote'
+
+    def test_assigned_product_list_is_tracked(self):
+        self.payment.products = [self.product]
+        assert isinstance(self.payment.products, ProductList)
+        self.payment.json
+        self.payment.products.pop()
+        assert self.payment.json['orderDetails']['products'] == []
+
+    def test_pickles_without_cache(self):
+        encoded = self.payment.encode()
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            payment = pickle.loads(pickle.dumps(self.payment, protocol))
+            assert payment._cache is None
+            assert payment.encode() == encoded
+            payment.contact.street = 'Toinenkatu 1'
+            assert payment.json['orderDetails']['contact']['address'][
+                'street'] == 'Toinenkatu 1'
+
+    def test_deep_copy_is_tracked(self):
+        self.payment.json
+        payment = copy.deepcopy(self.payment)
+        payment.products[0].price = '9.90'
+        assert payment.json['orderDetails']['products'][0]['price'] == '9.90'
+        assert self.payment.json['orderDetails']['products'][0][
+            'price'] == '19.90'
+
+    def test_assigned_list_is_copied(self):
+        products = []
+        self.payment.products = products
+        products.append(self.product)
+        assert len(self.payment.products) == 0
+
+    def test_clearing_product_list_invalidates_cache(self):
+        self.payment.json
+        if hasattr(list, 'clear'):
+            self.payment.products.clear()
+        else:
+            del self.payment.products[:]
+        assert self.payment.json['orderDetails']['products'] == []
+
+    def test_untracked_contact_is_not_cached(self):
+        self.payment.contact = flexmock(json={'email': 'a@example.com'})
+        data = self.payment.json
+        assert data['orderDetails']['contact'] == {'email': 'a@example.com'}
+        assert self.payment.json is not data
+
+
+class TestCompactModels(object):
+    def setup_method(self, method):
+        self.contact = CompactContact(
+            first_name='Matti',
+            last_name='Meikäläinen',
+            email='matti.meikalainen@gmail.com',
+            street='Esimerkkikatu 123',
+            postal_code='01234',
+            postal_office='Helsinki',
+            country='FI'
+        )
+        self.product = CompactProduct(title='Tuote', price='19.90', vat=23)
+        self.payment = CompactPayment(
+            order_number='12345678',
+            contact=self.contact,
+            success_url='https://www.esimerkkikauppa.fi/sv/success',
+            failure_url='https://www.esimerkkikauppa.fi/sv/failure',
+            notification_url='https://www.esimerkkikauppa.fi/sv/success'
+        )
+        self.payment.products.append(self.product)
+
+    def test_have_no_instance_dict(self):
+        for obj in (self.contact, self.product, self.payment):
+            assert not hasattr(obj, '__dict__')
+
+    def test_reject_unknown_attributes(self):
+        with raises(AttributeError):
+            self.product.colour = 'red'
+
+    def test_pickle(self):
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            payment = pickle.loads(pickle.dumps(self.payment, protocol))
+            assert type(payment) is CompactPayment
+            assert payment.encode() == self.payment.encode()
+
+    def test_json_equals_regular_models(self):
+        contact = Contact(
+            first_name='Matti',
+            last_name='Meikäläinen',
+            email='matti.meikalainen@gmail.com',
+            street='Esimerkkikatu 123',
+            postal_code='01234',
+            postal_office='Helsinki',
+            country='FI'
+        )
+        payment = Payment(
+            order_number='12345678',
+            contact=contact,
+            success_url='https://www.esimerkkikauppa.fi/sv/success',
+            failure_url='https://www.esimerkkikauppa.fi/sv/failure',
+            notification_url='https://www.esimerkkikauppa.fi/sv/success'
+        )
+        payment.products.append(Product(title='Tuote', price='19.90', vat=23))
+        assert self.payment.json == payment.json
+
+    def test_validates_product_type(self):
+        with raises(ValueError):
+            self.product.type = 0
+
+    def test_validates_currency(self):
+        with raises(ValueError):
+            self.payment.currency = 'USD'
+
+    def test_validates_locale(self):
+        with raises(ValueError):
+            self.payment.locale = 'de_DE'
+
+    def test_json_cache_is_invalidated(self):
+        self.payment.json
+        self.product.price = '9.90'
+        assert self.payment.json['orderDetails']['products'][0][
+            'price'] == '9.90'
+
+
+class TestProductTable(object):
+    def setup_method(self, method):
+        self.table = ProductTable()
+        self.table.append(
+            title='Esimerkkituote',
+            price='19.90',
+            vat=23,
+            amount=2,
+            code='XX-123',
+            discount=50,
+            type=Product.TYPE_POSTAGE
+        )
+
+    def test_json_equals_product_json(self):
+        product = Product(
+            title='Esimerkkituote',
+            price='19.90',
+            vat=23,
+            amount=2,
+            code='XX-123',
+            discount=50,
+            type=Product.TYPE_POSTAGE
+        )
+        assert self.table.json == [product.json]
+
+    def test_from_columns_uses_product_defaults(self):
+        table = ProductTable.from_columns(
+            ['A', 'B'], ['1.00', '2.00'], [23, 9])
+        assert table.json == [
+            Product(title='A', price='1.00', vat=23).json,
+            Product(title='B', price='2.00', vat=9).json,
+        ]
+
+    def test_rows_are_products(self):
+        assert len(self.table) == 1
+        assert isinstance(self.table[0], Product)
+        assert self.table[0].json == self.table.json[0]
+        assert [product.title for product in self.table] == ['Esimerkkituote']
+
+    def test_rows_are_read_only(self):
+        with raises(AttributeError):
+            self.table[0].price = '9.90'
+        assert self.table.json[0]['price'] == '19.90'
+        assert pickle.loads(pickle.dumps(self.table[0])).json == \
+            self.table.json[0]
+
+    def test_rows_must_be_read_one_at_a_time(self):
+        with raises(TypeError):
+            self.table[0:1]
+
+    def test_rows_can_be_replaced(self):
+        data = self.table.json
+        row = self.table[0]
+        self.table[0] = Product(row.title, '9.90', row.vat, amount=2)
+        assert self.table.json is not data
+        assert self.table.json[0]['price'] == '9.90'
+        assert self.table[0].amount == 2
+        with raises(IndexError):
+            self.table[1] = row
+        with raises(ValueError):
+            self.table[0] = flexmock(type=0)
+        assert len(self.table) == 1
+
+    def test_raises_value_error_on_unsupported_type(self):
+        with raises(ValueError) as exc_info:
+            self.table.extend(['A', 'B'], ['1.00', '1.00'], [23, 23],
+                              types=[Product.TYPE_NORMAL, 0])
+        assert str(exc_info.value) == 'Given product type not supported: 0'
+        assert len(self.table) == 1
+
+    def test_raises_value_error_on_column_length_mismatch(self):
+        with raises(ValueError):
+            self.table.extend(['A', 'B'], ['1.00'], [23, 23])
+
+    def test_raises_value_error_on_too_many_rows(self):
+        self.table.extend(['A'] * 499, ['1.00'] * 499, [23] * 499)
+        with raises(ValueError) as exc_info:
+            self.table.append('A', '1.00', 23)
+        assert str(exc_info.value) == \
+            'A payment can have at most 500 products.'
+        assert len(self.table) == 500
+
+    def test_assignable_to_payment_products(self):
+        payment = Payment(
+            order_number='1',
+            contact=Contact('Matti', 'Meikäläinen', 'matti@example.com',
+                            'Esimerkkikatu 123', '01234', 'Helsinki', 'FI'),
+            success_url='https://www.esimerkkikauppa.fi/sv/success',
+            failure_url='https://www.esimerkkikauppa.fi/sv/failure',
+            notification_url='https://www.esimerkkikauppa.fi/sv/success'
+        )
+        payment.products = self.table
+        assert payment.products is self.table
+        assert payment.json['orderDetails']['products'] == self.table.json
+        self.table.append('B', '1.00', 23)
+        assert len(payment.json['orderDetails']['products']) == 2
+
+
+class TestPaymentTemplate(object):
+    def setup_method(self, method):
+        self.template = PaymentTemplate(
+            success_url='https://www.esimerkkikauppa.fi/sv/success?a=100%',
+            failure_url='https://www.esimerkkikauppa.fi/sv/failure',
+            notification_url='https://www.esimerkkikauppa.fi/sv/notify',
+            locale='en_US'
+        )
+        self.contact = Contact('Matti', 'Meikäläinen', 'matti@example.com',
+                               'Esimerkkikatu 123', '01234', 'Helsinki', 'FI')
+        self.products = [
+            Product('Esimerkkituote', '19.90', '23.00', amount=2),
+            CompactProduct('Toimituskulut', 4.9, 23,
+                           type=Product.TYPE_POSTAGE),
+        ]
+
+    def make_payments(self, **options):
+        payment = self.template.payment(
+            '12345', self.contact, self.products, **options
+        )
+        regular = Payment(
+            '12345', self.contact,
+            success_url='https://www.esimerkkikauppa.fi/sv/success?a=100%',
+            failure_url='https://www.esimerkkikauppa.fi/sv/failure',
+            notification_url='https://www.esimerkkikauppa.fi/sv/notify',
+            locale='en_US',
+            **options
+        )
+        regular.products = self.products
+        return payment, regular
+
+    def test_encodes_like_regular_payment(self):
+        payment, regular = self.make_payments(description='Tilaus')
+        assert payment.encode() == regular.encode()
+        assert payment.json == regular.json
+
+    def test_encodes_many_products_and_compact_contact(self):
+        self.products = [
+            Product('Tuote %d' % n, '1.00', '23.00') for n in range(20)
+        ]
+        self.contact = CompactContact(
+            'Matti', 'Meikäläinen', 'matti@example.com',
+            'Esimerkkikatu 123', '01234', 'Helsinki', 'FI'
+        )
+        payment, regular = self.make_payments()
+        assert payment.encode() == regular.encode()
+
+    def test_encodes_product_table(self):
+        self.products = ProductTable.from_columns(
+            titles=['Esimerkkituote'], prices=['19.90'], vats=['23.00']
+        )
+        payment, regular = self.make_payments()
+        assert payment.encode() == regular.encode()
+
+    def test_encodes_with_custom_codec(self):
+        def dumps(data):
+            return json.dumps(data, separators=(',', ':')).encode('utf-8')
+        payment, regular = self.make_payments(reference_number='1232')
+        assert payment.encode(dumps) == regular.encode(dumps)
+
+    def test_falls_back_to_full_encoding_for_indenting_codec(self):
+        def dumps(data):
+            return json.dumps(data, indent=2)
+        payment, regular = self.make_payments()
+        assert payment.encode(dumps) == regular.encode(dumps)
+        data = json.loads(payment.encode(dumps))
+        assert len(data['orderDetails']['products']) == 2
+
+    def test_tracks_changes(self):
+        payment, regular = self.make_payments()
+        payment.encode()
+        payment.order_number = regular.order_number = '54321'
+        payment.products[0].amount = regular.products[0].amount = 3
+        assert payment.encode() == regular.encode()
+
+    def test_changed_constant_field_is_encoded_in_full(self):
+        payment, regular = self.make_payments()
+        payment.locale = regular.locale = 'sv_SE'
+        assert json.loads(payment.encode())['locale'] == 'sv_SE'
+        assert payment.encode() == regular.encode()
+
+    def test_pickles_encoded_payment(self):
+        payment, regular = self.make_payments()
+        encoded = payment.encode()
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            other = pickle.loads(pickle.dumps(payment, protocol))
+            assert other.encode() == encoded
+            other.order_number = regular.order_number = '54321'
+            assert other.encode() == regular.encode()
+            regular.order_number = '12345'
+
+    def test_validates_constant_fields(self):
+        with raises(ValueError):
+            PaymentTemplate('s', 'f', 'n', currency='USD')
+
+
+class TestContactCache(object):
+    def setup_method(self, method):
+        self.cache = ContactCache(max_size=2)
+        self.fields = ('Matti', 'Meikäläinen', 'matti@example.com',
+                       'Esimerkkikatu 123', '01234', 'Helsinki', 'FI')
+
+    def test_returns_shared_contact(self):
+        contact = self.cache.get(*self.fields)
+        assert self.cache.get(*self.fields) is contact
+        assert contact.json == Contact(*self.fields).json
+        assert (self.cache.hits, self.cache.misses) == (1, 1)
+
+    def test_contacts_are_immutable(self):
+        contact = self.cache.get(*self.fields)
+        with raises(AttributeError):
+            contact.email = 'matti@example.org'
+        with raises(AttributeError):
+            contact.nickname = 'Masa'
+
+    def test_copies_and_pickles(self):
+        contact = self.cache.get(*self.fields, mobile='0401234567')
+        copies = [copy.copy(contact), copy.deepcopy(contact)] + [
+            pickle.loads(pickle.dumps(contact, protocol))
+            for protocol in range(pickle.HIGHEST_PROTOCOL + 1)
+        ]
+        for other in copies:
+            assert type(other) is type(contact)
+            assert other.json == contact.json
+            with raises(AttributeError):
+                other.email = 'matti@example.org'
+
+    def test_payment_with_interned_contact_can_be_copied(self):
+        template = PaymentTemplate('s', 'f', 'n')
+        payment = template.payment(
+            '12345', self.cache.get(*self.fields),
+            [Product('Tuote', '19.90', '23.00')]
+        )
+        assert copy.deepcopy(payment).encode() == payment.encode()
+
+    def test_interns_contact(self):
+        contact = Contact(*self.fields, telephone='0401234567')
+        interned = self.cache.intern(contact)
+        assert interned.telephone == '0401234567'
+        assert self.cache.intern(contact) is interned
+        assert self.cache.get(*self.fields) is not interned
+
+    def test_evicts_least_recently_used(self):
+        first = self.cache.get(*self.fields)
+        self.cache.get('Maija', *self.fields[1:])
+        self.cache.get(*self.fields)
+        self.cache.get('Teppo', *self.fields[1:])
+        assert len(self.cache) == 2
+        assert self.cache.get(*self.fields) is first
+
+    def test_encoded_fragment_is_spliced_into_template_payment(self):
+        contact = self.cache.get(*self.fields)
+        fragment = contact.encode()
+        template = PaymentTemplate('s', 'f', 'n')
+        payment = template.payment(
+            '12345', contact, [Product('Tuote', '19.90', '23.00')]
+        )
+        assert fragment in payment.encode()
+        assert contact.encode() is fragment
+
+
+class TestPaymentValidation(object):
+    def setup_method(self, method):
+        self.payment = Payment(
+            order_number='1',
+            contact=Contact('Matti', 'Meikäläinen', 'matti@example.com',
+                            'Esimerkkikatu 123', '01234', 'Helsinki', 'FI'),
+            success_url='https://www.esimerkkikauppa.fi/sv/success',
+            failure_url='https://www.esimerkkikauppa.fi/sv/failure',
+            notification_url='https://www.esimerkkikauppa.fi/sv/success'
+        )
+        self.payment.products.append(
+            Product(title='A', price='19.90', vat='23.00', amount=2,
+                    discount=50)
+        )
+        self.payment.products.append(
+            Product(title='B', price=0.1, vat=24, amount=3)
+        )
+
+    def test_total_with_vat_included(self):
+        assert self.payment.total == Decimal('20.20')
+
+    def test_total_without_vat_included(self):
+        self.payment.include_vat = False
+        assert self.payment.total == Decimal('24.849')
+
+    def test_total_of_product_table(self):
+        self.payment.products = ProductTable.from_columns(
+            ['A', 'B'], ['19.90', 0.1], ['23.00', 24], amounts=[2, 3],
+            discounts=[50, 0]
+        )
+        assert self.payment.total == Decimal('20.20')
+
+    def test_total_is_updated_when_products_change(self):
+        self.payment.total
+        self.payment.products[1].amount = 13
+        assert self.payment.total == Decimal('21.20')
+
+    def test_valid_payment(self):
+        self.payment.validate()
+
+    def test_payment_without_products_is_invalid(self):
+        self.payment.products = []
+        with raises(VerkkomaksutException) as exc_info:
+            self.payment.validate()
+        assert exc_info.value.code == 'invalid-products'
+
+    def test_payment_with_too_many_products_is_invalid(self):
+        self.payment.products.extend(
+            Product(title='C', price='1.00', vat=23) for _ in range(499)
+        )
+        with raises(VerkkomaksutException) as exc_info:
+            self.payment.validate()
+        assert exc_info.value.code == 'invalid-products'
+
+    def test_payment_with_non_positive_total_is_invalid(self):
+        self.payment.products.append(
+            Product(title='Alennus', price='-20.20', vat=23)
+        )
+        with raises(VerkkomaksutException) as exc_info:
+            self.payment.validate()
+        assert exc_info.value.code == 'invalid-total'
+
+    def test_product_with_invalid_price_is_invalid(self):
+        self.payment.products[1].price = '1,00'
+        with raises(VerkkomaksutException) as exc_info:
+            self.payment.validate()
+        assert exc_info.value.code == 'invalid-products'
+        assert exc_info.value.message == \
+            'Invalid price, VAT, amount or discount on product row 2.'
+
+    def test_product_with_non_finite_price_is_invalid(self):
+        for price in ('nan', float('nan'), 'sNaN', 'inf', float('-inf')):
+            self.payment.products[1].price = price
+            with raises(VerkkomaksutException) as exc_info:
+                self.payment.validate()
+            assert exc_info.value.code == 'invalid-products'
+            assert exc_info.value.message == \
+                'Invalid price, VAT, amount or discount on product row 2.'
+
+    def test_client_rejects_invalid_payment_without_request(self):
+        self.payment.products = []
+        client = Client()
+        flexmock(client.session).should_receive('post').never()
+        with raises(VerkkomaksutException):
+            client.create_payment(self.payment)
+
+
 class MockPayment(object):
     def __init__(self, order_number='12345'):
         self.order_number = order_number
@@ -425,6 +1016,7 @@ class TestClient(object):
             .with_args(
                 'https://payment.verkkomaksut.fi/api-payment/create',
                 data='{"orderNumber": "12345"}',
+                timeout=None
             ) \
             .and_return(response)
 
@@ -451,6 +1043,7 @@ class TestClient(object):
             .with_args(
                 'https://payment.verkkomaksut.fi/api-payment/create',
                 data='{"orderNumber": "12345"}',
+                timeout=None
             ) \
             .and_return(response)
 
@@ -473,18 +1066,1363 @@ class TestClient(object):
 
     def test_validate_payment_receipt_parameters_ok(self):
         client = Client()
-        flexmock(client) \
-            .should_receive('_calculate_payment_receipt_hash') \
-            .with_args('order_number', 'timestamp', 'paid', 'method') \
-            .and_return('authcode')
         assert client._validate_payment_receipt_parameters(
-            'authcode', 'order_number', 'timestamp', 'paid', 'method')
+            '555E0C0DE304938AACA5D594DB72F315',
+            '15153', '1176557554', '012345ABCDE', '1')
 
     def test_validate_payment_receipt_parameters_fail(self):
         client = Client()
-        flexmock(client) \
-            .should_receive('_calculate_payment_receipt_hash') \
-            .with_args('order_number', 'timestamp', 'paid', 'method') \
-            .and_return('not_ok')
         assert not client._validate_payment_receipt_parameters(
-            'authcode', 'order_number', 'timestamp', 'paid', 'method')
+            '555E0C0DE304938AACA5D594DB72F316',
+            '15153', '1176557554', '012345ABCDE', '1')
+
+    def test_validate_successful_payment(self):
+        client = Client()
+        assert client.validate_successful_payment(
+            '555E0C0DE304938AACA5D594DB72F315',
+            '15153', '1176557554', '012345ABCDE', '1')
+
+    def test_validate_failed_payment(self):
+        client = Client()
+        authcode = client._calculate_payment_receipt_hash(
+            '15153', '1176557554')
+        assert client.validate_failed_payment(authcode, '15153', '1176557554')
+        assert not client.validate_failed_payment(
+            authcode, '15153', '1176557555')
+
+    def test_changing_merchant_secret_updates_receipt_validator(self):
+        client = Client()
+        client.merchant_secret = 'secret'
+        assert client.receipt_validator.merchant_secret == 'secret'
+
+
+class TestClientValidateReceipts(object):
+    def setup_method(self, method):
+        self.client = Client()
+        self.order_numbers = [str(n) for n in range(50)]
+        self.timestamps = ['1176557554'] * 50
+        self.paids = ['012345ABCDE'] * 50
+        self.methods = ['1'] * 50
+        self.authcodes = [
+            self.client._calculate_payment_receipt_hash(*receipt)
+            for receipt in zip(self.order_numbers, self.timestamps,
+                               self.paids, self.methods)
+        ]
+        self.authcodes[7] = self.authcodes[8]
+
+    def test_validates_successful_payments(self):
+        results = self.client.validate_receipts(
+            self.authcodes, self.order_numbers, self.timestamps,
+            self.paids, self.methods
+        )
+        assert isinstance(results, bytearray)
+        assert list(results) == [0 if n == 7 else 1 for n in range(50)]
+
+    def test_validates_failed_payments(self):
+        authcode = self.client._calculate_payment_receipt_hash(
+            '15153', '1176557554')
+        results = self.client.validate_receipts(
+            [authcode, authcode], ['15153', '15154'],
+            ['1176557554', '1176557554']
+        )
+        assert results == bytearray([1, 0])
+
+    def test_requires_both_paids_and_methods(self):
+        with raises(ValueError):
+            self.client.validate_receipts(
+                self.authcodes, self.order_numbers, self.timestamps,
+                self.paids
+            )
+
+    def test_validates_in_worker_processes(self):
+        results = self.client.validate_receipts(
+            self.authcodes, self.order_numbers, self.timestamps,
+            self.paids, self.methods, processes=2, chunk_size=16
+        )
+        assert list(results) == [0 if n == 7 else 1 for n in range(50)]
+
+
+class TestReplayProtection(object):
+    def setup_method(self, method):
+        self.client = Client(replay_cache=MemoryReplayCache())
+        self.timestamp = str(int(time.time()))
+
+    def success(self, order_number='12345', timestamp=None):
+        params = (order_number, timestamp or self.timestamp, 'ABCDEF1234',
+                  '1')
+        authcode = self.client._calculate_payment_receipt_hash(*params)
+        return (authcode,) + params
+
+    def test_rejects_replayed_successful_payment(self):
+        receipt = self.success()
+        assert self.client.validate_successful_payment(*receipt)
+        assert not self.client.validate_successful_payment(*receipt)
+        assert self.client.validate_successful_payment(*self.success('1'))
+
+    def test_rejects_replayed_failed_payment(self):
+        params = ('12345', self.timestamp)
+        authcode = self.client._calculate_payment_receipt_hash(*params)
+        assert self.client.validate_failed_payment(authcode, *params)
+        assert not self.client.validate_failed_payment(authcode, *params)
+
+    def test_invalid_receipt_is_not_remembered(self):
+        receipt = self.success()
+        assert not self.client.validate_successful_payment(
+            '0' * 32, *receipt[1:]
+        )
+        assert self.client.validate_successful_payment(*receipt)
+
+    def test_rejects_stale_receipt(self):
+        self.client.max_receipt_age = 60
+        stale = str(int(time.time()) - 120)
+        assert not self.client.validate_successful_payment(
+            *self.success(timestamp=stale)
+        )
+        assert self.client.validate_successful_payment(*self.success())
+
+    def test_memory_cache_expires_receipts(self):
+        cache = MemoryReplayCache(ttl=0)
+        assert cache.add(('1', '2'))
+        assert cache.add(('1', '2'))
+        assert len(cache) == 1
+
+    def test_memory_cache_is_bounded(self):
+        cache = MemoryReplayCache(max_size=2)
+        for key in ('1', '2', '3'):
+            assert cache.add((key,))
+        assert len(cache) == 2
+        assert cache.add(('1',))
+        assert not cache.add(('3',))
+
+    def test_sqlite_cache_is_shared(self, tmpdir):
+        path = str(tmpdir.join('receipts.db'))
+        first = SQLiteReplayCache(path)
+        second = SQLiteReplayCache(path)
+        assert first.add(('12345', '1176557554', 'ABCDEF1234'))
+        assert not second.add(('12345', '1176557554', 'ABCDEF1234'))
+        assert second.add(('12345', '1176557554', '0000000000'))
+        first.close()
+        second.close()
+
+    def test_sqlite_cache_expires_receipts(self, tmpdir):
+        cache = SQLiteReplayCache(str(tmpdir.join('receipts.db')), ttl=0)
+        assert cache.add(('1', '2'))
+        assert cache.add(('1', '2'))
+        cache.close()
+
+
+def success_params(client, order_number, paid='ABCDEF1234', method='1'):
+    params = {
+        'ORDER_NUMBER': order_number,
+        'TIMESTAMP': str(int(time.time())),
+        'PAID': paid,
+        'METHOD': method,
+    }
+    params['RETURN_AUTHCODE'] = client._calculate_payment_receipt_hash(
+        order_number, params['TIMESTAMP'], paid, method
+    )
+    return params
+
+
+def failure_params(client, order_number):
+    params = {
+        'ORDER_NUMBER': order_number,
+        'TIMESTAMP': str(int(time.time())),
+    }
+    params['RETURN_AUTHCODE'] = client._calculate_payment_receipt_hash(
+        order_number, params['TIMESTAMP']
+    )
+    return params
+
+
+class TestVerifyReceipt(object):
+    def setup_method(self, method):
+        self.client = Client()
+
+    def test_successful_payment(self):
+        params = success_params(self.client, '12345', paid='ABCDEF1234')
+        receipt = self.client.verify_receipt(params)
+        assert receipt == Receipt(
+            '12345', params['TIMESTAMP'], 'ABCDEF1234', '1'
+        )
+        assert not receipt.failed
+        assert not receipt.pending
+
+    def test_pending_payment(self):
+        params = success_params(self.client, '12345', paid='0000000000')
+        assert self.client.verify_receipt(params).pending
+
+    def test_failed_payment(self):
+        params = failure_params(self.client, '12345')
+        receipt = self.client.verify_receipt(params)
+        assert receipt.failed
+        assert receipt.params == ('12345', params['TIMESTAMP'])
+
+    def test_invalid_authcode(self):
+        params = success_params(self.client, '12345')
+        params['PAID'] = 'FFFFFFFFFF'
+        assert self.client.verify_receipt(params) is None
+
+    def test_missing_parameter(self):
+        params = success_params(self.client, '12345')
+        del params['METHOD']
+        assert self.client.verify_receipt(params) is None
+        assert self.client.verify_receipt({}) is None
+
+
+class TestNotificationPipeline(object):
+    def setup_method(self, method):
+        self.client = Client()
+        self.pipeline = NotificationPipeline(
+            self.client, max_queue=4, batch_size=3, batch_timeout=0.01
+        )
+
+    def test_yields_valid_receipts_in_order(self):
+        invalid = success_params(self.client, '2')
+        invalid['RETURN_AUTHCODE'] = '0' * 32
+        for params in (success_params(self.client, '1', paid='A'),
+                       invalid,
+                       failure_params(self.client, '3'),
+                       success_params(self.client, '4', paid='B')):
+            self.pipeline.put(params)
+        consumer = iter(self.pipeline)
+        receipts = [next(consumer) for _ in range(3)]
+        self.pipeline.close()
+        assert list(consumer) == []
+        assert [r.order_number for r in receipts] == ['1', '3', '4']
+        assert receipts[1].failed
+        assert self.pipeline.accepted == 3
+        assert self.pipeline.rejected == 1
+
+    def test_drops_duplicate_notifications(self):
+        pending = success_params(self.client, '1', paid='0000000000')
+        paid = success_params(self.client, '1', paid='ABCDEF1234')
+        receipts = self.pipeline.process([pending, paid, paid, pending])
+        assert [r.paid for r in receipts] == ['0000000000', 'ABCDEF1234']
+        assert self.pipeline.duplicates == 2
+
+    def test_applies_replay_cache(self):
+        self.pipeline.client.replay_cache = MemoryReplayCache()
+        self.pipeline.dedupe_size = 0
+        params = success_params(self.client, '1')
+        assert len(self.pipeline.process([params])) == 1
+        assert self.pipeline.process([params]) == []
+        assert self.pipeline.rejected == 1
+
+    def test_put_applies_backpressure(self):
+        for order_number in '1234':
+            self.pipeline.put(failure_params(self.client, order_number))
+        assert self.pipeline.qsize() == 4
+        with raises(Full):
+            self.pipeline.put(failure_params(self.client, '5'),
+                              timeout=0.01)
+
+
+class TestReceiptMiddleware(object):
+    def setup_method(self, method):
+        self.client = Client()
+        self.environs = []
+
+        def app(environ, start_response):
+            self.environs.append(environ)
+            start_response('200 OK', [])
+            return [b'OK']
+
+        self.middleware = ReceiptMiddleware(app, self.client, ['/success'])
+
+    def request(self, path, params):
+        responses = []
+        environ = {
+            'PATH_INFO': path,
+            'QUERY_STRING': urlencode(params),
+        }
+        body = self.middleware(
+            environ, lambda status, headers: responses.append(status)
+        )
+        return responses[0], b''.join(body)
+
+    def test_passes_valid_receipt_to_app(self):
+        params = success_params(self.client, '12345', paid='ABCDEF1234')
+        assert self.request('/success', params) == ('200 OK', b'OK')
+        receipt = self.environs[0]['verkkomaksut.receipt']
+        assert receipt.order_number == '12345'
+        assert receipt.paid == 'ABCDEF1234'
+
+    def test_rejects_forged_receipt(self):
+        params = success_params(self.client, '12345')
+        params['PAID'] = 'FFFFFFFFFF'
+        status, body = self.request('/success', params)
+        assert status == '400 Bad Request'
+        assert self.environs == []
+
+    def test_rejects_missing_receipt(self):
+        status, body = self.request('/success', {})
+        assert status == '400 Bad Request'
+
+    def test_ignores_other_paths(self):
+        assert self.request('/', {}) == ('200 OK', b'OK')
+        assert 'verkkomaksut.receipt' not in self.environs[0]
+
+
+@pytest.mark.skipif('sys.version_info < (3, 5)')
+class TestASGIReceiptMiddleware(object):
+    def setup_method(self, method):
+        from verkkomaksut.asgi import ReceiptMiddleware
+        self.client = Client()
+        self.scopes = []
+
+        def app(scope, receive, send):
+            import asyncio
+            self.scopes.append(scope)
+            return asyncio.sleep(0)
+
+        self.middleware = ReceiptMiddleware(app, self.client, ['/success'])
+
+    def request(self, path, params):
+        import asyncio
+        messages = []
+
+        def send(message):
+            messages.append(message)
+            return asyncio.sleep(0)
+
+        scope = {
+            'type': 'http',
+            'path': path,
+            'query_string': urlencode(params).encode('ascii'),
+        }
+        run_coroutine(self.middleware(scope, None, send))
+        return messages
+
+    def test_passes_valid_receipt_to_app(self):
+        params = failure_params(self.client, '12345')
+        assert self.request('/success', params) == []
+        assert self.scopes[0]['verkkomaksut.receipt'].failed
+
+    def test_rejects_forged_receipt(self):
+        params = failure_params(self.client, '12345')
+        params['ORDER_NUMBER'] = '54321'
+        messages = self.request('/success', params)
+        assert messages[0]['status'] == 400
+        assert self.scopes == []
+
+
+class TestLazyImport(object):
+    def run(self, code):
+        process = subprocess.Popen(
+            [sys.executable, '-c', code],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stdout=subprocess.PIPE
+        )
+        output = process.communicate()[0]
+        assert process.returncode == 0
+        return output.decode('ascii').strip()
+
+    def test_validation_does_not_import_requests(self):
+        assert self.run(
+            'import sys\n'
+            'import verkkomaksut\n'
+            'client = verkkomaksut.Client()\n'
+            'client.validate_failed_payment("0" * 32, "1", "2")\n'
+            'print("requests" in sys.modules)\n'
+        ) == 'False'
+
+    def test_session_imports_requests(self):
+        assert self.run(
+            'import sys\n'
+            'import verkkomaksut\n'
+            'verkkomaksut.Client().session\n'
+            'print("requests" in sys.modules)\n'
+        ) == 'True'
+
+
+class TestReceiptValidator(object):
+    def setup_method(self, method):
+        self.validator = ReceiptValidator('6pKF4jkv97zmqBJ3ZL8gUw5DfT2NMQ')
+        self.params = ('15153', '1176557554', '012345ABCDE', '1')
+
+    def test_calculate_hash(self):
+        assert self.validator.calculate_hash(*self.params) == \
+            '555E0C0DE304938AACA5D594DB72F315'
+
+    def test_validate_ok(self):
+        assert self.validator.validate(
+            '555E0C0DE304938AACA5D594DB72F315', *self.params)
+
+    def test_validate_is_case_insensitive(self):
+        assert self.validator.validate(
+            '555e0c0de304938aaca5d594db72f315', *self.params)
+
+    def test_validate_fail(self):
+        assert not self.validator.validate(
+            '555E0C0DE304938AACA5D594DB72F316', *self.params)
+
+    def test_validate_rejects_malformed_authcode(self):
+        assert not self.validator.validate('not hex', *self.params)
+        assert not self.validator.validate('555', *self.params)
+        assert not self.validator.validate(u'\xe4\xe4', *self.params)
+
+    def test_validate_successful_payment(self):
+        assert self.validator.validate_successful_payment(
+            '555E0C0DE304938AACA5D594DB72F315', *self.params)
+
+    def test_validate_failed_payment(self):
+        authcode = self.validator.calculate_hash('15153', '1176557554')
+        assert self.validator.validate_failed_payment(
+            authcode, '15153', '1176557554')
+
+    def test_accepts_unicode_parameters(self):
+        assert self.validator.validate(
+            '555E0C0DE304938AACA5D594DB72F315',
+            *[u'%s' % param for param in self.params])
+
+
+class TestClientCodec(object):
+    def setup_method(self, method):
+        self.calls = []
+
+        def dumps(data):
+            self.calls.append('dumps')
+            return json.dumps(data, separators=(',', ':')).encode('utf-8')
+
+        def loads(content):
+            self.calls.append('loads')
+            return json.loads(content)
+
+        self.client = Client(codec=JSONCodec(dumps=dumps, loads=loads))
+
+    def test_defaults_to_json_module(self):
+        codec = Client().codec
+        data = {'orderNumber': '12345', 'price': 19.9}
+        assert codec.dumps(data) == json.dumps(data)
+        assert codec.loads(json.dumps(data)) == data
+
+    def test_encodes_and_decodes_with_codec(self):
+        response = requests.Response()
+        response._content = b'{"orderNumber": "1", "token": "t", "url": "u"}'
+        response.status_code = requests.codes.created
+        flexmock(self.client.session) \
+            .should_receive('post') \
+            .with_args(
+                'https://payment.verkkomaksut.fi/api-payment/create',
+                data=b'{"orderNumber":"12345"}',
+                timeout=None
+            ) \
+            .and_return(response)
+
+        assert self.client.create_payment(MockPayment()) == {
+            'order_number': '1', 'token': 't', 'url': 'u'
+        }
+        assert self.calls == ['dumps', 'loads']
+
+    def test_encoded_payment_is_cached_per_codec(self):
+        payment = Payment(
+            order_number='1',
+            contact=Contact('Matti', 'Meikäläinen', 'matti@example.com',
+                            'Esimerkkikatu 123', '01234', 'Helsinki', 'FI'),
+            success_url='https://www.esimerkkikauppa.fi/sv/success',
+            failure_url='https://www.esimerkkikauppa.fi/sv/failure',
+            notification_url='https://www.esimerkkikauppa.fi/sv/success'
+        )
+        body = self.client._encode_payment(payment)
+        assert self.client._encode_payment(payment) is body
+        assert self.calls == ['dumps']
+        assert Client()._encode_payment(payment) == json.dumps(payment.json)
+
+
+def make_response(status_code, content):
+    response = requests.Response()
+    response._content = content
+    response.status_code = status_code
+    return response
+
+
+CREATED_RESPONSE = make_response(
+    201, b'{"orderNumber": "12345", "token": "t", "url": "u"}'
+)
+
+
+class TestClientRetry(object):
+    def setup_method(self, method):
+        self.client = Client(
+            retry=RetryPolicy(max_attempts=3, backoff=0), timeout=5
+        )
+        self.bodies = []
+        self.outcomes = []
+
+        def post(url, data, timeout):
+            self.bodies.append(data)
+            outcome = self.outcomes.pop(0)
+            if isinstance(outcome, Exception):
+                raise outcome
+            return outcome
+
+        self.client.session.post = post
+
+    def test_retries_connection_errors(self):
+        self.outcomes = [requests.ConnectionError(), CREATED_RESPONSE]
+        assert self.client.create_payment(MockPayment()) == {
+            'order_number': '12345', 'token': 't', 'url': 'u'
+        }
+        assert self.bodies == ['{"orderNumber": "12345"}'] * 2
+
+    def test_retries_server_errors(self):
+        self.outcomes = [make_response(503, b'Unavailable'), CREATED_RESPONSE]
+        assert self.client.create_payment(MockPayment())['token'] == 't'
+        assert len(self.bodies) == 2
+
+    def test_does_not_retry_client_errors(self):
+        self.outcomes = [make_response(
+            400, b'{"errorCode": "invalid-order-number", "errorMessage": ""}'
+        )]
+        with raises(VerkkomaksutException) as exc_info:
+            self.client.create_payment(MockPayment())
+        assert exc_info.value.code == 'invalid-order-number'
+        assert len(self.bodies) == 1
+
+    def test_does_not_retry_timeouts(self):
+        self.outcomes = [requests.Timeout()]
+        with raises(requests.Timeout):
+            self.client.create_payment(MockPayment())
+
+    def test_raises_last_connection_error(self):
+        self.outcomes = [requests.ConnectionError()] * 3
+        with raises(requests.ConnectionError):
+            self.client.create_payment(MockPayment())
+        assert len(self.bodies) == 3
+
+    def test_returns_last_server_error(self):
+        self.outcomes = [make_response(
+            500, b'{"errorCode": "internal-error", "errorMessage": ""}'
+        )] * 3
+        with raises(VerkkomaksutException) as exc_info:
+            self.client.create_payment(MockPayment())
+        assert exc_info.value.code == 'internal-error'
+        assert len(self.bodies) == 3
+
+    def test_reports_invalid_response(self):
+        self.outcomes = [make_response(502, b'<html>Bad Gateway</html>')] * 3
+        with raises(VerkkomaksutException) as exc_info:
+            self.client.create_payment(MockPayment())
+        assert exc_info.value.code == 'invalid-response'
+
+    def test_deadline_stops_retrying(self):
+        self.client.retry = RetryPolicy(
+            max_attempts=10, backoff=1, jitter=False, deadline=0.5
+        )
+        self.outcomes = [requests.ConnectionError()] * 10
+        with raises(requests.ConnectionError):
+            self.client.create_payment(MockPayment())
+        assert len(self.bodies) == 1
+
+
+class TestRetryPolicy(object):
+    def test_delay_grows_exponentially(self):
+        policy = RetryPolicy(backoff=0.1, max_backoff=1, jitter=False)
+        assert [policy.delay(n) for n in range(1, 6)] == \
+            [0.1, 0.2, 0.4, 0.8, 1]
+
+    def test_jitter_stays_below_delay(self):
+        policy = RetryPolicy(backoff=0.1, jitter=True)
+        assert all(0 <= policy.delay(3) <= 0.4 for _ in range(100))
+
+    def test_limits_attempts(self):
+        policy = RetryPolicy(max_attempts=2)
+        assert policy.next_delay(1, None) is not None
+        assert policy.next_delay(2, None) is None
+
+
+class TestRateLimiter(object):
+    def test_token_bucket_allows_burst(self):
+        limiter = RateLimiter(rate=10, burst=2)
+        assert limiter.try_acquire() is not None
+        assert limiter.try_acquire() is not None
+        assert limiter.try_acquire() is None
+        assert 0 < limiter.wait_time() <= 0.1
+
+    def test_tokens_are_refilled(self):
+        limiter = RateLimiter(rate=100, burst=1)
+        limiter.try_acquire()
+        started = time.time()
+        limiter.acquire()
+        assert 0 < time.time() - started < 0.5
+
+    def test_limits_requests_in_flight(self):
+        limiter = RateLimiter(max_in_flight=1)
+        permit = limiter.try_acquire()
+        assert limiter.try_acquire() is None
+        limiter.release(permit)
+        assert limiter.try_acquire() is not None
+
+    def test_client_holds_permit_during_request(self):
+        limiter = RateLimiter(max_in_flight=1)
+        client = Client(rate_limiter=limiter)
+        in_flight = []
+
+        def post(url, data, timeout):
+            in_flight.append(limiter.try_acquire())
+            return CREATED_RESPONSE
+
+        client.session.post = post
+        client.create_payment(MockPayment())
+        assert in_flight == [None]
+        assert limiter.try_acquire() is not None
+
+
+class TestCircuitBreaker(object):
+    def setup_method(self, method):
+        self.breaker = CircuitBreaker(
+            failure_threshold=0.5, window=4, min_calls=4, reset_timeout=0
+        )
+
+    def record(self, *outcomes):
+        for failed in outcomes:
+            assert self.breaker.allow()
+            self.breaker.record(failed, 0)
+
+    def test_stays_closed_below_threshold(self):
+        self.record(False, False, False, True)
+        assert self.breaker.state == CircuitBreaker.CLOSED
+
+    def test_opens_at_threshold(self):
+        self.breaker.reset_timeout = 60
+        self.record(False, True, False, True)
+        assert self.breaker.state == CircuitBreaker.OPEN
+        assert not self.breaker.allow()
+
+    def test_slow_calls_count_as_failures(self):
+        self.breaker.reset_timeout = 60
+        self.breaker.slow_call_duration = 1
+        for duration in (2, 2, 0, 0):
+            self.breaker.allow()
+            self.breaker.record(False, duration)
+        assert self.breaker.state == CircuitBreaker.OPEN
+
+    def test_half_open_allows_one_trial(self):
+        self.record(True, True, True, True)
+        assert self.breaker.state == CircuitBreaker.HALF_OPEN
+        assert self.breaker.allow()
+        assert not self.breaker.allow()
+
+    def test_successful_trial_closes(self):
+        self.record(True, True, True, True)
+        self.record(False)
+        assert self.breaker.state == CircuitBreaker.CLOSED
+
+    def test_failed_trial_reopens(self):
+        self.record(True, True, True, True)
+        assert self.breaker.state == CircuitBreaker.HALF_OPEN
+        self.breaker.reset_timeout = 60
+        self.record(True)
+        assert self.breaker.state == CircuitBreaker.OPEN
+
+    def test_client_fails_fast_while_open(self):
+        breaker = CircuitBreaker(window=2, min_calls=2, reset_timeout=60)
+        client = Client(circuit_breaker=breaker)
+        (flexmock(client.session)
+            .should_receive('post')
+            .and_return(make_response(
+                500, b'{"errorCode": "internal-error", "errorMessage": ""}'
+            ))
+            .times(2))
+        for _ in range(2):
+            with raises(VerkkomaksutException):
+                client.create_payment(MockPayment())
+        with raises(VerkkomaksutException) as exc_info:
+            client.create_payment(MockPayment())
+        assert exc_info.value.code == 'circuit-open'
+
+    def test_failed_permit_keeps_half_open_trial(self):
+        breaker = CircuitBreaker(window=1, min_calls=1, reset_timeout=0)
+        self.breaker = breaker
+        self.record(True)
+        limiter = flexmock(RateLimiter())
+        limiter.should_receive('acquire').and_raise(IOError)
+        client = Client(circuit_breaker=breaker, rate_limiter=limiter)
+        with raises(IOError):
+            client.create_payment(MockPayment())
+        assert breaker.state == CircuitBreaker.HALF_OPEN
+        assert breaker.allow()
+
+    def test_client_records_connection_errors(self):
+        breaker = CircuitBreaker(window=1, min_calls=1, reset_timeout=60)
+        client = Client(circuit_breaker=breaker)
+        (flexmock(client.session)
+            .should_receive('post')
+            .and_raise(requests.ConnectionError))
+        with raises(requests.ConnectionError):
+            client.create_payment(MockPayment())
+        assert breaker.state == CircuitBreaker.OPEN
+
+
+class TestClientMetrics(object):
+    def setup_method(self, method):
+        self.recorded = []
+        self.client = Client(metrics=flexmock(record=self.recorded.append))
+
+    def test_records_successful_call(self):
+        flexmock(self.client.session).should_receive('post') \
+            .and_return(CREATED_RESPONSE)
+        self.client.create_payment(MockPayment())
+        metrics, = self.recorded
+        assert metrics.order_number == '12345'
+        assert metrics.payload_size == len(b'{"orderNumber": "12345"}')
+        assert metrics.product_count == 0
+        assert metrics.status_code == 201
+        assert metrics.error_code is None
+        assert all(metrics[i] >= 0 for i in range(1, 5))
+
+    def test_does_not_build_json_of_template_payment(self):
+        template = PaymentTemplate('s', 'f', 'n')
+        payment = template.payment(
+            '12345',
+            Contact('Matti', 'Meikäläinen', 'matti@example.com',
+                    'Esimerkkikatu 123', '01234', 'Helsinki', 'FI'),
+            [Product('Tuote', '19.90', '23.00')]
+        )
+        flexmock(payment).should_receive('_build_json').never()
+        flexmock(self.client.session).should_receive('post') \
+            .and_return(CREATED_RESPONSE)
+        self.client.create_payment(payment)
+        metrics, = self.recorded
+        assert metrics.product_count == 1
+        assert metrics.payload_size == len(payment.encode())
+
+    def test_records_api_error(self):
+        flexmock(self.client.session).should_receive('post').and_return(
+            make_response(400, b'{"errorCode": "invalid-order-number", '
+                               b'"errorMessage": ""}')
+        )
+        with raises(VerkkomaksutException):
+            self.client.create_payment(MockPayment())
+        metrics, = self.recorded
+        assert metrics.status_code == 400
+        assert metrics.error_code == 'invalid-order-number'
+
+    def test_records_connection_error(self):
+        flexmock(self.client.session).should_receive('post') \
+            .and_raise(requests.ConnectionError)
+        with raises(requests.ConnectionError):
+            self.client.create_payment(MockPayment())
+        metrics, = self.recorded
+        assert metrics.status_code is None
+        assert metrics.error_code == 'ConnectionError'
+        assert metrics.decode == 0
+
+
+class TestHistogramRecorder(object):
+    def make_metrics(self, network, status_code=201, error_code=None):
+        return RequestMetrics('12345', 0.001, 0.001, network, 0.001, 300, 2,
+                              status_code, error_code)
+
+    def test_histogram_quantile(self):
+        histogram = Histogram([1, 2, 3])
+        for value in (0.5, 1.5, 1.5, 2.5):
+            histogram.observe(value)
+        assert histogram.quantile(0.5) == 2
+        assert histogram.quantile(1) == 3
+        histogram.observe(4)
+        assert histogram.quantile(1) is None
+        assert histogram.snapshot()['buckets'][-1] == (float('inf'), 5)
+
+    def test_snapshot(self):
+        recorder = HistogramRecorder()
+        recorder.record(self.make_metrics(0.02))
+        recorder.record(self.make_metrics(0.2, 500, 'internal-error'))
+        data = recorder.snapshot()
+        assert data['network']['count'] == 2
+        assert data['network']['sum'] == pytest.approx(0.22)
+        assert data['payload_size']['sum'] == 600
+        assert data['status_codes'] == {201: 1, 500: 1}
+        assert data['error_codes'] == {'internal-error': 1}
+
+    def test_prometheus(self):
+        recorder = HistogramRecorder()
+        recorder.record(self.make_metrics(0.02))
+        text = recorder.prometheus()
+        assert 'verkkomaksut_request_network_seconds_bucket{le="0.025"} 1' \
+            in text
+        assert 'verkkomaksut_request_network_seconds_count 1' in text
+        assert 'verkkomaksut_requests_total{status="201"} 1' in text
+
+
+class TestFileRateLimiter(object):
+    def test_shares_token_bucket(self, tmpdir):
+        path = str(tmpdir.join('bucket'))
+        first = FileRateLimiter(path, rate=1, burst=2)
+        second = FileRateLimiter(path, rate=1, burst=2)
+        assert first.try_acquire() is not None
+        assert second.try_acquire() is not None
+        assert first.try_acquire() is None
+        assert second.try_acquire() is None
+        assert 0 < first.wait_time() <= 1
+
+    def test_shares_request_slots(self, tmpdir):
+        path = str(tmpdir.join('bucket'))
+        first = FileRateLimiter(path, max_in_flight=1)
+        second = FileRateLimiter(path, max_in_flight=1)
+        permit = first.try_acquire()
+        assert permit is not None
+        try:
+            assert second.try_acquire() is None
+        finally:
+            first.release(permit)
+        permit = second.try_acquire()
+        assert permit is not None
+        second.release(permit)
+
+
+class TestClientCreatePayments(object):
+    def setup_method(self, method):
+        self.client = Client()
+        self.payments = [MockPayment(str(n)) for n in range(20)]
+
+        def create_payment(payment):
+            if payment.order_number == '13':
+                raise VerkkomaksutException('invalid-order-number', 'Bad')
+            return {'order_number': payment.order_number}
+
+        self.client.create_payment = create_payment
+
+    def test_yields_results_in_order(self):
+        results = list(
+            self.client.create_payments(self.payments, max_concurrency=4)
+        )
+        assert [r.payment for r in results] == self.payments
+
+    def test_yields_results_in_completion_order(self):
+        results = list(self.client.create_payments(
+            self.payments, max_concurrency=4, ordered=False
+        ))
+        assert sorted(r.payment.order_number for r in results) == \
+            sorted(p.order_number for p in self.payments)
+
+    def test_result_carries_created_payment(self):
+        result = next(self.client.create_payments(self.payments[:1]))
+        assert result == PaymentResult(
+            self.payments[0], {'order_number': '0'}, None
+        )
+
+    def test_failed_payment_does_not_abort_batch(self):
+        results = list(self.client.create_payments(self.payments))
+        assert len(results) == 20
+        assert results[13].data is None
+        assert results[13].error.code == 'invalid-order-number'
+        assert results[14].data == {'order_number': '14'}
+
+    def test_rejects_invalid_concurrency(self):
+        for max_concurrency in (0, -1):
+            with raises(ValueError):
+                self.client.create_payments(self.payments, max_concurrency)
+
+    def test_consumes_payments_lazily(self):
+        consumed = []
+
+        def payments():
+            for payment in self.payments:
+                consumed.append(payment)
+                yield payment
+
+        results = self.client.create_payments(payments(), max_concurrency=2)
+        next(results)
+        results.close()
+        assert len(consumed) < len(self.payments)
+
+
+ORDER_EXPORT = u"""\
+order_number,first_name,last_name,email,street,postal_code,postal_office,\
+country,title,price,vat,amount,type
+1,Matti,Meikäläinen,matti@example.com,Katu 1,01234,Helsinki,FI,Kirja,\
+19.90,10.00,2,
+1,Matti,Meikäläinen,matti@example.com,Katu 1,01234,Helsinki,FI,Posti,\
+4.90,24.00,,2
+2,Maija,Meikäläinen,maija@example.com,Katu 2,01234,Helsinki,FI,Kynä,\
+1.50,24.00,,
+3,Matti,Meikäläinen,matti@example.com,Katu 1,01234,Helsinki,FI,Kumi,\
+0.50,24.00,,
+"""
+
+
+class TestImporter(object):
+    def setup_method(self, method):
+        self.template = PaymentTemplate(
+            success_url='https://www.esimerkkikauppa.fi/sv/success',
+            failure_url='https://www.esimerkkikauppa.fi/sv/failure',
+            notification_url='https://www.esimerkkikauppa.fi/sv/notify'
+        )
+
+        self.contact_row = {
+            'order_number': '1', 'first_name': 'Matti',
+            'last_name': 'Meikalainen', 'email': 'matti@example.com',
+            'street': 'Katu 1', 'postal_code': '01234',
+            'postal_office': 'Helsinki', 'country': 'FI'
+        }
+
+    def read_export(self):
+        if bytes is str:
+            export = io.BytesIO(ORDER_EXPORT.encode('utf-8'))
+        else:
+            export = io.StringIO(ORDER_EXPORT)
+        return read_csv(export)
+
+    def test_reads_csv(self):
+        row = next(self.read_export())
+        assert row['order_number'] == u'1'
+        assert row['last_name'] == u'Meikäläinen'
+        assert row['type'] == u''
+
+    def test_reads_json_lines(self):
+        export = io.StringIO(u'{"order_number": "1"}\n\n{"order_number": 2}\n')
+        assert list(read_json_lines(export)) == [
+            {'order_number': '1'}, {'order_number': 2}
+        ]
+
+    def test_groups_rows_by_order(self):
+        payments = list(build_payments(self.read_export(), self.template))
+        assert [p.order_number for p in payments] == [u'1', u'2', u'3']
+        assert payments[0].products.json == [
+            {'title': u'Kirja', 'code': None, 'amount': 2,
+             'price': 19.9, 'vat': 10.0, 'discount': 0, 'type': 1},
+            {'title': u'Posti', 'code': None, 'amount': 1,
+             'price': 4.9, 'vat': 24.0, 'discount': 0, 'type': 2},
+        ]
+        assert payments[0].total == Decimal('44.70')
+        assert payments[0].success_url == self.template._prototype.success_url
+
+    def test_shares_contacts_of_repeat_customers(self):
+        contacts = ContactCache()
+        payments = list(
+            build_payments(self.read_export(), self.template, contacts)
+        )
+        assert payments[0].contact is payments[2].contact
+        assert payments[1].contact.first_name == u'Maija'
+        assert (contacts.hits, contacts.misses) == (1, 2)
+
+    def test_converts_numeric_columns(self):
+        rows = [dict(self.contact_row, title='Kirja', price='10',
+                     vat=24, amount='1.5', discount='5', type='3')]
+        payment, = build_payments(rows, self.template)
+        assert payment.products.json[0] == {
+            'title': 'Kirja', 'code': None, 'amount': 1.5, 'price': 10,
+            'vat': 24, 'discount': 5, 'type': 3
+        }
+
+    def test_rejects_invalid_numeric_columns(self):
+        for column, value in (('type', '1.0'), ('price', '1,00')):
+            row = dict(self.contact_row, title='Kirja', price='1', vat='24')
+            row[column] = value
+            with raises(ValueError) as exc_info:
+                list(build_payments([row], self.template))
+            assert str(exc_info.value) == \
+                "Order '1' has an invalid %s column." % column
+
+    def test_builds_payments_lazily(self):
+        consumed = []
+
+        def rows():
+            for row in self.read_export():
+                consumed.append(row)
+                yield row
+
+        next(build_payments(rows(), self.template))
+        assert len(consumed) == 3
+
+    def test_rejects_missing_columns(self):
+        rows = [{'order_number': '1', 'first_name': 'Matti'}]
+        with raises(ValueError):
+            list(build_payments(rows, self.template))
+        with raises(ValueError):
+            list(build_payments([{'title': 'Kirja'}], self.template))
+
+    def test_imports_payments_in_chunks(self):
+        client = Client()
+        chunks = []
+
+        def create_payments(payments, max_concurrency):
+            chunks.append([p.order_number for p in payments])
+            for payment in payments:
+                yield PaymentResult(payment, {'orderNumber': '1'}, None)
+
+        client.create_payments = create_payments
+        results = list(import_payments(
+            client, self.read_export(), self.template, chunk_size=2
+        ))
+        assert chunks == [[u'1', u'2'], [u'3']]
+        assert [r.payment.order_number for r in results] == [u'1', u'2', u'3']
+
+    def test_imports_payments_to_server(self):
+        with StubServer() as server:
+            client = Client()
+            client.SERVICE_URL = server.service_url
+            results = list(import_payments(
+                client, self.read_export(), self.template, max_concurrency=2
+            ))
+            client.session.close()
+            assert [r.error for r in results] == [None] * 3
+            assert len(server.payments[u'1']['orderDetails']['products']) \
+                == 2
+
+
+class TestStubServer(object):
+    def setup_method(self, method):
+        self.server = StubServer().start()
+        self.client = Client()
+        self.client.SERVICE_URL = self.server.service_url
+        self.payment = Payment(
+            order_number='12345',
+            contact=Contact('Matti', 'Meikäläinen', 'matti@example.com',
+                            'Esimerkkikatu 123', '01234', 'Helsinki', 'FI'),
+            success_url='https://www.esimerkkikauppa.fi/sv/success',
+            failure_url='https://www.esimerkkikauppa.fi/sv/failure',
+            notification_url='https://www.esimerkkikauppa.fi/sv/success'
+        )
+        self.payment.products.append(
+            Product(title='Esimerkkituote', price='19.90', vat='23.00')
+        )
+
+    def teardown_method(self, method):
+        self.client.session.close()
+        self.server.stop()
+
+    def test_creates_payment(self):
+        result = self.client.create_payment(self.payment)
+        assert result['order_number'] == '12345'
+        assert result['url'].endswith('/payment/load/token/' +
+                                      result['token'])
+        assert self.server.payments['12345'] == \
+            json.loads(self.payment.encode())
+
+    def test_rejects_invalid_credentials(self):
+        client = Client(merchant_id='12345', merchant_secret='secret')
+        client.SERVICE_URL = self.server.service_url
+        with raises(VerkkomaksutException) as exc_info:
+            client.create_payment(self.payment)
+        assert exc_info.value.code == 'invalid-credentials'
+
+    def test_rejects_missing_order_number(self):
+        with raises(VerkkomaksutException) as exc_info:
+            self.client.create_payment(MockPayment(order_number=''))
+        assert exc_info.value.code == 'invalid-order-number'
+
+    def test_injects_errors(self):
+        self.server.error_rate = 1
+        with raises(VerkkomaksutException) as exc_info:
+            self.client.create_payment(self.payment)
+        assert exc_info.value.code == 'internal-error'
+
+    def test_throttles_requests(self):
+        self.server.max_requests_per_second = 0
+        with raises(VerkkomaksutException) as exc_info:
+            self.client.create_payment(self.payment)
+        assert exc_info.value.code == 'too-many-requests'
+
+    def test_signs_success_callback(self):
+        params = self.server.success_callback('12345', paid='0123456789')
+        assert params['PAID'] == '0123456789'
+        assert self.client.validate_successful_payment(
+            params['RETURN_AUTHCODE'], params['ORDER_NUMBER'],
+            params['TIMESTAMP'], params['PAID'], params['METHOD']
+        )
+
+    def test_signs_failure_callback(self):
+        params = self.server.failure_callback('12345', timestamp=1176557554)
+        assert params['TIMESTAMP'] == '1176557554'
+        assert self.client.validate_failed_payment(
+            params['RETURN_AUTHCODE'], params['ORDER_NUMBER'],
+            params['TIMESTAMP']
+        )
+
+
+def run_coroutine(coroutine):
+    import asyncio
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+class MockAsyncResponse(object):
+    def __init__(self, status, content):
+        self.status = status
+        self.content = content
+
+    def __aenter__(self):
+        import asyncio
+        return asyncio.sleep(0, result=self)
+
+    def __aexit__(self, exc_type, exc_value, traceback):
+        import asyncio
+        return asyncio.sleep(0)
+
+    def read(self):
+        import asyncio
+        return asyncio.sleep(0, result=self.content)
+
+
+class TestClientConnectionPool(object):
+    def setup_method(self, method):
+        self.server = StubServer().start()
+
+    def teardown_method(self, method):
+        self.server.stop()
+
+    def make_client(self, **options):
+        client = Client(**options)
+        client.SERVICE_URL = self.server.service_url
+        return client
+
+    def test_mounts_pool_adapter(self):
+        client = self.make_client(pool_maxsize=4)
+        assert client.session.get_adapter(client.SERVICE_URL) is \
+            client.adapter
+        assert client.adapter._pool_maxsize == 4
+
+    def test_idle_connection_is_reused(self):
+        client = self.make_client()
+        assert client.pool_stats() == {'active': 0, 'idle': 0, 'waiting': 0}
+        client.create_payment(MockPayment())
+        client.create_payment(MockPayment())
+        assert client.pool_stats() == {'active': 0, 'idle': 1, 'waiting': 0}
+
+    def test_counts_waiting_requests(self):
+        self.server.latency = 0.2
+        client = self.make_client(pool_maxsize=1, pool_block=True)
+        worker = threading.Thread(
+            target=lambda: list(client.create_payments([MockPayment()] * 3))
+        )
+        worker.start()
+        deadline = time.time() + 1
+        while client.pool_stats()['waiting'] < 2 and time.time() < deadline:
+            time.sleep(0.01)
+        assert client.pool_stats()['active'] == 1
+        assert client.pool_stats()['waiting'] == 2
+        worker.join()
+
+    def test_keep_alive_can_be_disabled(self):
+        client = self.make_client(keep_alive=False)
+        assert client.session.headers['Connection'] == 'close'
+
+
+class TestClientThreadSafety(object):
+    def setup_method(self, method):
+        self.server = StubServer(latency=0.02).start()
+        self.client = Client(pool_maxsize=8)
+        self.client.SERVICE_URL = self.server.service_url
+
+    def teardown_method(self, method):
+        self.client.adapter.close()
+        self.server.stop()
+
+    def run_threads(self, thread_count, payments_per_thread):
+        results = {}
+        sessions = set()
+
+        def work(thread):
+            sessions.add(self.client.session)
+            for n in range(payments_per_thread):
+                order_number = '%d-%d' % (thread, n)
+                try:
+                    data = self.client.create_payment(
+                        MockPayment(order_number)
+                    )
+                except Exception as exc:
+                    data = exc
+                results[order_number] = data
+
+        threads = [
+            threading.Thread(target=work, args=(thread,))
+            for thread in range(thread_count)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results, sessions
+
+    def test_threads_have_own_sessions_over_shared_pool(self):
+        sessions = []
+        thread = threading.Thread(
+            target=lambda: sessions.append(self.client.session)
+        )
+        thread.start()
+        thread.join()
+        assert sessions[0] is not self.client.session
+        assert sessions[0].get_adapter(self.client.SERVICE_URL) is \
+            self.client.session.get_adapter(self.client.SERVICE_URL) is \
+            self.client.adapter
+
+    def test_assigned_session_is_shared(self):
+        session = requests.Session()
+        self.client.session = session
+        sessions = []
+        thread = threading.Thread(
+            target=lambda: sessions.append(self.client.session)
+        )
+        thread.start()
+        thread.join()
+        assert sessions == [session]
+
+    def test_concurrent_payments(self):
+        results, sessions = self.run_threads(16, 10)
+        assert len(sessions) == 16
+        assert sorted(results) == sorted(self.server.payments)
+        for order_number, data in results.items():
+            assert data['order_number'] == order_number
+        assert self.client.pool_stats()['idle'] <= 8
+
+    def test_requests_are_in_flight_concurrently(self):
+        lock = threading.Lock()
+        all_in_flight = threading.Event()
+        in_flight = []
+
+        def latency():
+            with lock:
+                in_flight.append(None)
+                if len(in_flight) == 8:
+                    all_in_flight.set()
+            all_in_flight.wait(5)
+            return 0
+
+        self.server.latency = latency
+        results, _ = self.run_threads(8, 1)
+        assert all_in_flight.is_set()
+        assert len(results) == len(self.server.payments) == 8
+
+
+class TestClientRegistry(object):
+    def setup_method(self, method):
+        self.registry = ClientRegistry(max_clients=2, timeout=5)
+
+    def test_returns_same_client_for_merchant(self):
+        client = self.registry.get('1', 'secret')
+        assert self.registry.get('1', 'secret') is client
+        assert client.merchant_id == '1'
+        assert client.timeout == 5
+
+    def test_clients_share_adapter(self):
+        first = self.registry.get('1', 'secret')
+        second = self.registry.get('2', 'secret')
+        assert first.adapter is second.adapter is self.registry.adapter
+        assert second.session.get_adapter(second.SERVICE_URL) is \
+            self.registry.adapter
+
+    def test_updates_changed_secret(self):
+        client = self.registry.get('1', 'secret')
+        assert self.registry.get('1', 'new secret') is client
+        assert client.session.auth == ('1', 'new secret')
+        assert client.receipt_validator.merchant_secret == 'new secret'
+
+    def test_evicts_least_recently_used(self):
+        self.registry.get('1', 'secret')
+        self.registry.get('2', 'secret')
+        self.registry.get('1', 'secret')
+        self.registry.get('3', 'secret')
+        assert len(self.registry) == 2
+        assert '1' in self.registry
+        assert '2' not in self.registry
+
+    def test_creates_payments_over_shared_pool(self):
+        with StubServer(merchant_id='1', merchant_secret='secret') as server:
+            client = self.registry.get('1', 'secret')
+            client.SERVICE_URL = server.service_url
+            client.create_payment(MockPayment())
+            assert self.registry.pool_stats()['idle'] == 1
+            self.registry.close()
+
+
+@pytest.mark.skipif('sys.version_info < (3, 5)')
+class TestAsyncClient(object):
+    def setup_method(self, method):
+        aio = pytest.importorskip('verkkomaksut.aio')
+        self.client = aio.AsyncClient()
+
+    def run(self, coroutine):
+        return run_coroutine(coroutine)
+
+    def test_defaults_to_merchant_test_account(self):
+        assert self.client.merchant_id == '13466'
+        assert self.client.merchant_secret == '6pKF4jkv97zmqBJ3ZL8gUw5DfT2NMQ'
+
+    def test_successful_payment_creation(self):
+        response = MockAsyncResponse(201, b"""{
+  "orderNumber": "12345",
+  "token": "secret_token",
+  "url": "https://payment.verkkomaksut.fi/payment/load/token/secret_token"
+}""")
+        session = flexmock(closed=False)
+        session.should_receive('post').with_args(
+            'https://payment.verkkomaksut.fi/api-payment/create',
+            data='{"orderNumber": "12345"}',
+        ).and_return(response)
+        self.client._session = session
+
+        assert self.run(self.client.create_payment(MockPayment())) == {
+            'order_number': '12345',
+            'token': 'secret_token',
+            'url': 'https://payment.verkkomaksut.fi/payment/load/token/'
+                   'secret_token'
+        }
+
+    def test_payment_creation_failure(self):
+        response = MockAsyncResponse(400, b"""{
+  "errorCode": "invalid-order-number",
+  "errorMessage": "Missing or invalid order number"
+}""")
+        session = flexmock(closed=False)
+        session.should_receive('post').and_return(response)
+        self.client._session = session
+
+        with raises(VerkkomaksutException) as exc_info:
+            self.run(self.client.create_payment(MockPayment()))
+
+        assert exc_info.value.code == 'invalid-order-number'
+
+    def test_holds_rate_limiter_permit_during_request(self):
+        limiter = RateLimiter(max_in_flight=1)
+        self.client.rate_limiter = limiter
+        in_flight = []
+
+        def post(url, data):
+            in_flight.append(limiter.try_acquire())
+            return MockAsyncResponse(201, b"""{
+  "orderNumber": "12345", "token": "t", "url": "u"
+}""")
+
+        self.client._session = flexmock(closed=False, post=post)
+        self.run(self.client.create_payment(MockPayment()))
+        assert in_flight == [None]
+        assert limiter.try_acquire() is not None
+
+    def test_cancelled_wait_for_permit_keeps_half_open_trial(self):
+        import asyncio
+        breaker = CircuitBreaker(window=1, min_calls=1, reset_timeout=0)
+        breaker.allow()
+        breaker.record(True, 0)
+        limiter = RateLimiter(max_in_flight=1)
+        permit = limiter.try_acquire()
+        self.client.circuit_breaker = breaker
+        self.client.rate_limiter = limiter
+        with raises(asyncio.TimeoutError):
+            self.run(asyncio.wait_for(
+                self.client.create_payment(MockPayment()), 0.05
+            ))
+        limiter.release(permit)
+        assert breaker.state == CircuitBreaker.HALF_OPEN
+        assert breaker.allow()
+
+    def test_records_metrics(self):
+        recorder = HistogramRecorder()
+        self.client.metrics = recorder
+        session = flexmock(closed=False)
+        session.should_receive('post').and_return(MockAsyncResponse(201, b"""{
+  "orderNumber": "12345", "token": "t", "url": "u"
+}"""))
+        self.client._session = session
+        self.run(self.client.create_payment(MockPayment()))
+        assert recorder.snapshot()['status_codes'] == {201: 1}
+
+    def test_calculate_payment_receipt_hash(self):
+        assert self.client._calculate_payment_receipt_hash(
+            '15153', '1176557554', '012345ABCDE', '1'
+        ) == '555E0C0DE304938AACA5D594DB72F315'
@@ -10,9 +10,34 @@
 """
 __version__ = '0.2.0'
 
+import binascii
 import hashlib
-import json
-import requests
+import hmac
+import threading
+import time
+from array import array
+from collections import OrderedDict, namedtuple
+from decimal import Decimal, InvalidOperation
+from itertools import islice
+from operator import attrgetter
+
+from .metrics import HistogramRecorder, RequestMetrics
+from .policies import (
+    CircuitBreaker,
+    FileRateLimiter,
+    RateLimiter,
+    RetryPolicy
+)
+
+try:
+    from itertools import izip as zip
+except ImportError:  # Python 3
+    pass
+
+try:
+    from queue import Queue
+except ImportError:  # Python 2
+    from Queue import Queue
 
 
 class VerkkomaksutException(Exception):
@@ -32,48 +57,238 @@ class VerkkomaksutException(Exception):
         self.message = message
 
 
-class Contact(object):
+#: The outcome of creating a single payment with `Client.create_payments`.
+#: Exactly one of `data` and `error` is set: `data` is the `dict` returned by
+#: `Client.create_payment`, and `error` is the exception (usually a
+#: `VerkkomaksutException`) raised while creating the payment.
+PaymentResult = namedtuple('PaymentResult', ['payment', 'data', 'error'])
+
+
+class Receipt(namedtuple('Receipt', [
+    'order_number', 'timestamp', 'paid', 'method'
+])):
+    """A validated payment receipt, as returned by `Client.verify_receipt`.
+    `paid` and `method` are `None` for a cancelled or failed payment."""
+
+    __slots__ = ()
+
+    #: The payment code of a pending payment.
+    PENDING_CODE = '0000000000'
+
+    @property
+    def failed(self):
+        """`True` if the payment was cancelled or failed."""
+        return self.paid is None
+
+    @property
+    def pending(self):
+        """`True` if the payment is pending confirmation."""
+        return self.paid == self.PENDING_CODE
+
+    @property
+    def params(self):
+        """The parameters of the receipt covered by its authcode."""
+        if self.paid is None:
+            return (self.order_number, self.timestamp)
+        return tuple(self)
+
+
+def _parse_receipt(params):
+    """Returns the authcode and the `Receipt` in the given query parameters,
+    or ``(None, None)`` if a parameter is missing."""
+    try:
+        authcode = params['RETURN_AUTHCODE']
+        order_number = params['ORDER_NUMBER']
+        timestamp = params['TIMESTAMP']
+    except KeyError:
+        return None, None
+    paid = params.get('PAID')
+    method = params.get('METHOD')
+    if (paid is None) != (method is None):
+        return None, None
+    return authcode, Receipt(order_number, timestamp, paid, method)
+
+
+_missing = object()
+
+#: Sets a field of a model without counting it as a change.
+_set = object.__setattr__
+
+
+class _Model(object):
+    """Base class of the payment data models.
+
+    Changes to the fields of a model are tracked so that its JSON
+    representation is built and encoded only once for each revision of the
+    model.  The constructors start the revision with `_init_revision` and
+    set the fields with `_set`, which does not count as a change.
+    """
+
+    __slots__ = ('_version', '_cache')
+
+    #: Attributes that are left out when the model is pickled or copied.
+    _transient = frozenset(['_version', '_cache'])
+
+    def _init_revision(self):
+        _set(self, '_version', 0)
+        _set(self, '_cache', None)
+
+    def __getstate__(self):
+        state = dict(getattr(self, '__dict__', ()))
+        for cls in type(self).__mro__:
+            for name in cls.__dict__.get('__slots__', ()):
+                if hasattr(self, name):
+                    state[name] = getattr(self, name)
+        for name in self._transient:
+            state.pop(name, None)
+        return state
+
+    def __setstate__(self, state):
+        self._init_revision()
+        for name, value in state.items():
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        object.__setattr__(self, '_version', self._version + 1)
+
+    def _stamp(self):
+        """Returns a value that changes whenever the JSON representation of
+        this model may have changed, or `None` if changes cannot be
+        tracked."""
+        return self._version
+
+    def _build_json(self):
+        raise NotImplementedError
+
+    def _revision(self):
+        """Returns a dict for the values derived from the current revision
+        of this model, such as its encodings."""
+        stamp = self._stamp()
+        cache = self._cache
+        if stamp is None or cache is None or cache[0] != stamp:
+            cache = (stamp, {})
+            if stamp is not None:
+                _set(self, '_cache', cache)
+        return cache[1]
+
+    @property
+    def json(self):
+        """JSON representation of this object.  A new dict is built on every
+        access, so it can be modified freely."""
+        return self._build_json()
+
+    def encode(self, dumps=None):
+        """Returns the JSON representation of this object encoded with
+        `dumps`, which defaults to `json.dumps`.  The result is cached until
+        the object changes."""
+        if dumps is None:
+            dumps = _json_dumps
+        derived = self._revision()
+        try:
+            return derived[dumps]
+        except KeyError:
+            derived[dumps] = result = dumps(self._build_json())
+            return result
+
+
+def _stamp_of(obj):
+    stamp = getattr(obj, '_stamp', None)
+    return stamp() if stamp is not None else None
+
+
+class ProductList(list):
+    """The list of products of a `Payment`.  It behaves like a regular list,
+    but keeps track of modifications so that the JSON representation of the
+    payment can be cached."""
+
+    _version = 0
+
+    def _tracked(name):
+        method = getattr(list, name)
+
+        def wrapper(self, *args, **kwargs):
+            self._version += 1
+            return method(self, *args, **kwargs)
+        wrapper.__name__ = name
+        return wrapper
+
+    append = _tracked('append')
+    extend = _tracked('extend')
+    insert = _tracked('insert')
+    pop = _tracked('pop')
+    remove = _tracked('remove')
+    reverse = _tracked('reverse')
+    sort = _tracked('sort')
+    __setitem__ = _tracked('__setitem__')
+    __delitem__ = _tracked('__delitem__')
+    __iadd__ = _tracked('__iadd__')
+    __imul__ = _tracked('__imul__')
+    if hasattr(list, 'clear'):  # Python 3
+        clear = _tracked('clear')
+    if hasattr(list, '__setslice__'):  # Python 2
+        __setslice__ = _tracked('__setslice__')
+        __delslice__ = _tracked('__delslice__')
+    del _tracked
+
+    def _stamp(self):
+        try:
+            return (self._version, tuple([p._version for p in self]))
+        except AttributeError:
+            return None
+
+    @property
+    def json(self):
+        """JSON representation of the products."""
+        return [product.json for product in self]
+
+    def _price_rows(self):
+        for product in self:
+            yield product.price, product.vat, product.amount, product.discount
+
+
+class Contact(_Model):
     """This class represents the payer of a payment."""
 
     def __init__(self, first_name, last_name, email, street, postal_code,
                        postal_office, country, telephone=None, mobile=None,
                        company_name=None):
+        self._init_revision()
+
         #: Payer's first name.
-        self.first_name = first_name
+        _set(self, 'first_name', first_name)
 
         #: Payer's surname.
-        self.last_name = last_name
+        _set(self, 'last_name', last_name)
 
         #: Payer's email address.
-        self.email = email
+        _set(self, 'email', email)
 
         #: Company name.
-        self.company_name = company_name
+        _set(self, 'company_name', company_name)
 
         #: Payer's telephone number.
-        self.telephone = telephone
+        _set(self, 'telephone', telephone)
 
         #: Payer's mobile number.
-        self.mobile = mobile
+        _set(self, 'mobile', mobile)
 
         #: Payer's street address.
-        self.street = street
+        _set(self, 'street', street)
 
         #: Payer's postal code.
-        self.postal_code = postal_code
+        _set(self, 'postal_code', postal_code)
 
         #: Payer's post office.
-        self.postal_office = postal_office
+        _set(self, 'postal_office', postal_office)
 
         #: Payer's country.  The data are sent as a two-numbered character
         #: string in ISO-3166-1 standard format.  For example, Finnish is FI
         #: and Swedish SE.  The data are used for verifying credit history,
         #: and is thus required.
-        self.country = country
+        _set(self, 'country', country)
 
-    @property
-    def json(self):
-        """JSON representation of this contact."""
+    def _build_json(self):
         return {
             'telephone': self.telephone,
             'mobile': self.mobile,
@@ -90,65 +305,86 @@ class Contact(object):
         }
 
 
-class Payment(object):
+_TOTAL = object()
+
+
+def _invalid_products(message):
+    return VerkkomaksutException(code='invalid-products', message=message)
+
+
+def _decimal(value):
+    if isinstance(value, Decimal):
+        return value
+    return Decimal(str(value))
+
+
+class Payment(_Model):
+    #: The maximum number of products in a payment.
+    MAX_PRODUCTS = 500
+
     def __init__(self, order_number, contact, success_url, failure_url,
                        notification_url, **options):
+        self._init_revision()
+
         #: Order number is a string of characters identifying the customer's
         #: purchase and the used webshop software creates it.
-        self.order_number = order_number
+        _set(self, 'order_number', order_number)
 
         #: Reference number is sent to bank by default and is automatically
         #: created.  In those payment methods that are used as an interface,
         #: this field can contain own reference number, which is sent to the
         #: bank service instead of the automatically generated reference
         #: number.
-        self.reference_number = options.get('reference_number')
+        _set(self, 'reference_number', options.get('reference_number'))
 
         #: Any data about the order in text format can be sent to the payment
         #: system.  The most usual pieces of data are customer name and contact
         #: information and order product information.  They are shown in the
         #: Merchant's Panel in payment details.
-        self.description = options.get('description')
+        _set(self, 'description', options.get('description'))
 
         #: Payment currency.  Value must EUR for the Finnish banks, otherwise
         #: the payment will not be accepted.
-        self.currency = options.get('currency', 'EUR')
+        _set(self, 'currency', options.get('currency', 'EUR'))
 
         #: Localisation defines default language for the payment method
         #: selection page and presentation format for the sums.  Available
         #: localisations are "fi_FI", "sv_SE" and "en_US". The default
         #: localisation is always "fi_FI".
-        self.locale = options.get('locale', 'fi_FI')
+        _set(self, 'locale', options.get('locale', 'fi_FI'))
 
         #: A flag indicating whether the product row prices include value
         #: added tax.  If `True` VAT is included in the shown price; otherwise
         #: it will be added.  Therefore, set this to `True`, if the prices in
         #: your webshop include value added tax, and `False` if the prices do
         #: not include value added tax.
-        self.include_vat = options.get('include_vat', True)
+        _set(self, 'include_vat', options.get('include_vat', True))
 
-        self.contact = contact
+        _set(self, 'contact', contact)
 
         #: A list of products. There must be at least one product, and the
-        #: maximum number of products is 500.
-        self.products = []
+        #: maximum number of products is 500.  Lists assigned to this
+        #: attribute are copied to a new `ProductList`, so later changes to
+        #: the assigned list do not affect the payment.  A `ProductTable` can
+        #: be assigned instead for orders with many products.
+        _set(self, 'products', [])
 
         #: URL to which user is directed after a successful payment.
-        self.success_url = success_url
+        _set(self, 'success_url', success_url)
 
         #: URL to which user is directed after a cancelled or failed payment.
-        self.failure_url = failure_url
+        _set(self, 'failure_url', failure_url)
 
         #: URL to which user is directed, if the payment is pending.  The
         #: status is with NetPosti payment method.  After the actual payment,
         #: the payment is signed for receipt with notify request.
-        self.pending_url = options.get('pending_url')
+        _set(self, 'pending_url', options.get('pending_url'))
 
         #: URL requested when the payment is marked as successful.  The URL is
         #: requested with the same GET parameters as success address when the
         #: payment is made.  Notification request is typically executed within
         #: a few minutes from the payment.
-        self.notification_url = notification_url
+        _set(self, 'notification_url', notification_url)
 
     @property
     def currency(self):
@@ -158,7 +394,7 @@ class Payment(object):
     def currency(self, value):
         if value != 'EUR':
             raise ValueError("Currently EUR is the only supported currency.")
-        self._currency = value
+        _set(self, '_currency', value)
 
     @property
     def locale(self):
@@ -168,10 +404,91 @@ class Payment(object):
     def locale(self, value):
         if value not in ('fi_FI', 'sv_SE', 'en_US'):
             raise ValueError("Given locale is not supported: %r" % value)
-        self._locale = value
+        _set(self, '_locale', value)
 
     @property
-    def json(self):
+    def products(self):
+        return self._products
+
+    @products.setter
+    def products(self, value):
+        if not isinstance(value, (ProductList, ProductTable)):
+            value = ProductList(value)
+        _set(self, '_products', value)
+
+    def _stamp(self):
+        stamps = (_stamp_of(self.contact), self.products._stamp())
+        if None in stamps:
+            return None
+        return (self._version,) + stamps
+
+    @property
+    def total(self):
+        """The total sum of the product rows as an exact `decimal.Decimal`.
+        The sum of a row is its `price` times `amount`, reduced by the
+        `discount` percentage.  If `include_vat` is `False`, the `vat`
+        percentage is added to it.  The total is cached until the payment
+        changes.
+
+        :raises VerkkomaksutException: if a product row has a value that is
+            not a number.
+        """
+        derived = self._revision()
+        try:
+            return derived[_TOTAL]
+        except KeyError:
+            derived[_TOTAL] = total = self._calculate_total()
+            return total
+
+    def _calculate_total(self):
+        include_vat = self.include_vat
+        hundred = Decimal(100)
+        total = Decimal(0)
+        rows = enumerate(self.products._price_rows(), 1)
+        for row, (price, vat, amount, discount) in rows:
+            try:
+                row_total = (
+                    _decimal(price) * _decimal(amount) *
+                    (hundred - _decimal(discount))
+                )
+                if include_vat:
+                    row_total *= hundred
+                else:
+                    row_total *= hundred + _decimal(vat)
+                if not row_total.is_finite():
+                    raise ValueError
+            except (InvalidOperation, ValueError):
+                raise _invalid_products(
+                    'Invalid price, VAT, amount or discount on product row '
+                    '%d.' % row
+                )
+            total += row_total
+        if not total.is_finite():
+            raise _invalid_products('The total amount is not a number.')
+        return total / (hundred * hundred)
+
+    def validate(self):
+        """Checks the payment locally before it is sent to Suomen
+        Verkkomaksut, so that payments that are certain to be rejected fail
+        without a round trip to the API.  The payment must have between 1 and
+        `MAX_PRODUCTS` product rows, and its `total` must be positive.
+
+        :raises VerkkomaksutException: if the payment is invalid.
+        """
+        if not 0 < len(self.products) <= self.MAX_PRODUCTS:
+            raise VerkkomaksutException(
+                code='invalid-products',
+                message='A payment must have between 1 and %d products.'
+                        % self.MAX_PRODUCTS
+            )
+        if self.total <= 0:
+            raise VerkkomaksutException(
+                code='invalid-total',
+                message='The total amount of the payment must be greater '
+                        'than zero.'
+            )
+
+    def _build_json(self):
         return {
             'orderNumber': self.order_number,
             'referenceNumber': self.reference_number,
@@ -187,47 +504,49 @@ class Payment(object):
             'orderDetails': {
                 'includeVat': '1' if self.include_vat else '0',
                 'contact': self.contact.json,
-                'products': [product.json for product in self.products]
+                'products': self.products.json
             }
         }
 
 
-class Product(object):
+class Product(_Model):
     TYPE_NORMAL = 1
     TYPE_POSTAGE = 2
     TYPE_PROCESSING = 3
 
     def __init__(self, title, price, vat, amount=1, code=None, discount=0, type=TYPE_NORMAL):
+        self._init_revision()
+
         #: Product name in free format.  The product title is shown in the
         #: Merchant's Panel and on Klarna service invoices on a product row.
         #: Product details are shown also on the payment method selection page.
-        self.title = title
+        _set(self, 'title', title)
 
         #: Optional product number. Using a product number may help in
         #: aligning a correct product.
-        self.code = code
+        _set(self, 'code', code)
 
         #: If an order consists of several samples of the same product, you
         #: can enter the number of products here and there won't be a need for
         #: adding each product as a separate row.  Usually this field contains
         #: value 1.
-        self.amount = amount
+        _set(self, 'amount', amount)
 
         #: Price for one product.  If the field payment includes VAT, this is
         #: a price excluding VAT.  Otherwise, this is a price including VAT.
         #: The price can also be negative if you want to add discounts to the
         #: service.  However, the total amount of the product rows must always
         #: be bigger than 0.
-        self.price = price
+        _set(self, 'price', price)
 
         #: Tax percentage for a product.  The value added tax in Finland for
         #: most products is 23.
-        self.vat = vat
+        _set(self, 'vat', vat)
 
         #: If you have reduced the product price, you can show the discount
         #: percentage as a figure between 0 and 100 in this field.  Default
         #: discount value is 0.
-        self.discount = discount
+        _set(self, 'discount', discount)
 
         #: A type can be specified for the product row.  `Product.TYPE_NORMAL`
         #: refers to a normal product row.  `Product.TYPE_POSTAGE` can be used
@@ -235,7 +554,7 @@ class Product(object):
         #: `Product.TYPE_NORMAL` can be used for all rows, but postage and
         #: processing costs cannot be differentiated from other rows to the
         #: invoice.  Default value for the field is `Product.TYPE_NORMAL`.
-        self.type = type
+        _set(self, 'type', type)
 
     @property
     def type(self):
@@ -249,10 +568,9 @@ class Product(object):
             Product.TYPE_PROCESSING
         ):
             raise ValueError('Given product type not supported: %r' % value)
-        self._type = value
+        _set(self, '_type', value)
 
-    @property
-    def json(self):
+    def _build_json(self):
         return {
             'title': self.title,
             'code': self.code,
@@ -264,11 +582,779 @@ class Product(object):
         }
 
 
-class Client(object):
+class ProductTable(object):
+    """Stores the products of a payment column by column.
+
+    A product table can be assigned to `Payment.products` instead of a list
+    of `Product` objects.  Rows are added without creating a `Product` for
+    each of them, and the JSON representation is built straight from the
+    columns.  Product types are kept in a compact byte array.
+
+    The rows are validated like `Product` objects, and a table can hold at
+    most `MAX_ROWS` rows.
+    """
+
+    #: The maximum number of products in a payment.
+    MAX_ROWS = Payment.MAX_PRODUCTS
+
+    _TYPES = frozenset(
+        [Product.TYPE_NORMAL, Product.TYPE_POSTAGE, Product.TYPE_PROCESSING]
+    )
+
+    def __init__(self):
+        self._version = 0
+        self._titles = []
+        self._codes = []
+        self._amounts = []
+        self._prices = []
+        self._vats = []
+        self._discounts = []
+        self._types = array('B')
+
+    @classmethod
+    def from_columns(cls, titles, prices, vats, amounts=None, codes=None,
+                     discounts=None, types=None):
+        """Creates a table from columns.  See `extend` for the parameters."""
+        table = cls()
+        table.extend(titles, prices, vats, amounts, codes, discounts, types)
+        return table
+
+    def append(self, title, price, vat, amount=1, code=None, discount=0,
+               type=Product.TYPE_NORMAL):
+        """Adds a product row.  The parameters are the same as for
+        `Product`."""
+        self.extend([title], [price], [vat], [amount], [code], [discount],
+                    [type])
+
+    def extend(self, titles, prices, vats, amounts=None, codes=None,
+               discounts=None, types=None):
+        """Adds many product rows at once.  Each parameter is a sequence
+        holding one column; the optional columns default to the defaults of
+        `Product`.  The rows are validated before any of them is added.
+
+        :raises ValueError: if the columns have different lengths, a product
+            type is not supported, or the table would have more than
+            `MAX_ROWS` rows.
+        """
+        count = len(titles)
+        columns = [
+            list(titles),
+            list(codes) if codes is not None else [None] * count,
+            list(amounts) if amounts is not None else [1] * count,
+            list(prices),
+            list(vats),
+            list(discounts) if discounts is not None else [0] * count,
+            list(types) if types is not None
+            else [Product.TYPE_NORMAL] * count,
+        ]
+        if any(len(column) != count for column in columns):
+            raise ValueError('All columns must have the same length.')
+        if len(self) + count > self.MAX_ROWS:
+            raise ValueError(
+                'A payment can have at most %d products.' % self.MAX_ROWS
+            )
+        invalid = set(columns[-1]) - self._TYPES
+        if invalid:
+            raise ValueError(
+                'Given product type not supported: %r' % min(invalid)
+            )
+
+        self._titles.extend(columns[0])
+        self._codes.extend(columns[1])
+        self._amounts.extend(columns[2])
+        self._prices.extend(columns[3])
+        self._vats.extend(columns[4])
+        self._discounts.extend(columns[5])
+        self._types.extend(columns[6])
+        self._version += 1
+
+    def __len__(self):
+        return len(self._titles)
+
+    def __getitem__(self, index):
+        """Returns the row at `index` as a new read-only `Product`.  To
+        change a row, assign a `Product` to it."""
+        if isinstance(index, slice):
+            raise TypeError('Product table rows must be read one at a time.')
+        return _ProductRow(
+            title=self._titles[index],
+            price=self._prices[index],
+            vat=self._vats[index],
+            amount=self._amounts[index],
+            code=self._codes[index],
+            discount=self._discounts[index],
+            type=self._types[index]
+        )
+
+    def __setitem__(self, index, product):
+        """Replaces the row at `index` with the fields of `product`.
+
+        :raises ValueError: if the product type is not supported.
+        """
+        if isinstance(index, slice):
+            raise TypeError('Product table rows must be set one at a time.')
+        self._titles[index]
+        if product.type not in self._TYPES:
+            raise ValueError(
+                'Given product type not supported: %r' % product.type
+            )
+        self._titles[index] = product.title
+        self._codes[index] = product.code
+        self._amounts[index] = product.amount
+        self._prices[index] = product.price
+        self._vats[index] = product.vat
+        self._discounts[index] = product.discount
+        self._types[index] = product.type
+        self._version += 1
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def _stamp(self):
+        return self._version
+
+    def _price_rows(self):
+        return zip(self._prices, self._vats, self._amounts, self._discounts)
+
+    @property
+    def json(self):
+        """JSON representation of the products, built straight from the
+        columns."""
+        keys = ('title', 'code', 'amount', 'price', 'vat', 'discount', 'type')
+        rows = zip(self._titles, self._codes, self._amounts, self._prices,
+                   self._vats, self._discounts, self._types)
+        return [dict(zip(keys, row)) for row in rows]
+
+
+def _compact(cls, slots):
+    namespace = dict(
+        (key, value) for key, value in vars(cls).items()
+        if key not in ('__dict__', '__weakref__', '__qualname__')
+    )
+    namespace['__slots__'] = slots
+    namespace['__doc__'] = (
+        "Memory-efficient version of `%s`.  The fields are stored in slots "
+        "instead of an instance dictionary, so no other attributes can be "
+        "set.  The constructor and validation are the same as in `%s`."
+        % (cls.__name__, cls.__name__)
+    )
+    return type('Compact' + cls.__name__, cls.__bases__, namespace)
+
+
+CompactContact = _compact(Contact, (
+    'first_name', 'last_name', 'email', 'company_name', 'telephone',
+    'mobile', 'street', 'postal_code', 'postal_office', 'country'
+))
+
+CompactPayment = _compact(Payment, (
+    'order_number', 'reference_number', 'description', '_currency',
+    '_locale', 'include_vat', 'contact', '_products', 'success_url',
+    'failure_url', 'pending_url', 'notification_url'
+))
+
+CompactProduct = _compact(Product, (
+    'title', 'code', 'amount', 'price', 'vat', 'discount', '_type'
+))
+
+
+class _ProductRow(Product):
+    """A row of a `ProductTable`.  Changes to it would not reach the table,
+    so its fields cannot be changed."""
+
+    def __init__(self, *args, **kwargs):
+        super(_ProductRow, self).__init__(*args, **kwargs)
+        object.__setattr__(self, '_frozen', True)
+
+    def __setattr__(self, name, value):
+        if getattr(self, '_frozen', False):
+            raise AttributeError(
+                'Rows of a ProductTable cannot be changed; assign a Product '
+                'to the row instead.'
+            )
+        super(_ProductRow, self).__setattr__(name, value)
+
+    def __reduce__(self):
+        return Product, (
+            self.title, self.price, self.vat, self.amount, self.code,
+            self.discount, self.type
+        )
+
+
+class FrozenContact(CompactContact):
+    """An immutable `CompactContact`, as returned by `ContactCache`.  Its
+    fields cannot be changed after it has been created, so one instance and
+    its cached JSON representation can be shared by any number of payments.
+    """
+
+    __slots__ = ('_frozen',)
+
+    def __init__(self, *args, **kwargs):
+        super(FrozenContact, self).__init__(*args, **kwargs)
+        object.__setattr__(self, '_frozen', True)
+
+    def __setattr__(self, name, value):
+        if getattr(self, '_frozen', False):
+            raise AttributeError('FrozenContact objects cannot be changed.')
+        super(FrozenContact, self).__setattr__(name, value)
+
+    def __reduce__(self):
+        return FrozenContact, tuple([
+            getattr(self, field) for field in ContactCache.FIELDS
+        ])
+
+
+class ContactCache(object):
+    """Interns the contacts of repeat customers.  `get` returns the same
+    `FrozenContact` for the same fields, so its JSON representation is built
+    and encoded only once and spliced into the request body of every
+    payment of the customer created with a `PaymentTemplate`.
+
+    At most `max_size` contacts are kept; the least recently used ones are
+    dropped first.  One cache can be shared by many threads.
+
+    :param max_size: The maximum number of contacts kept.
+    :param dumps: The function the JSON of each contact is encoded with
+        when it is added, so that the encoded fragment is ready for the
+        first payment.  Use the `dumps` of the codec of your client.
+        Defaults to `json.dumps`.
+    """
+
+    #: The fields identifying a contact, in the order of the arguments of
+    #: `Contact`.
+    FIELDS = (
+        'first_name', 'last_name', 'email', 'street', 'postal_code',
+        'postal_office', 'country', 'telephone', 'mobile', 'company_name'
+    )
+
+    def __init__(self, max_size=10000, dumps=None):
+        self.max_size = max_size
+        self.dumps = dumps or _json_dumps
+
+        #: The number of `get` calls that returned a cached contact.
+        self.hits = 0
+
+        #: The number of `get` calls that created a new contact.
+        self.misses = 0
+
+        self._contacts = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, first_name, last_name, email, street, postal_code,
+            postal_office, country, telephone=None, mobile=None,
+            company_name=None):
+        """Returns the shared `FrozenContact` with the given fields.  The
+        arguments are the same as for `Contact`."""
+        key = (first_name, last_name, email, street, postal_code,
+               postal_office, country, telephone, mobile, company_name)
+        with self._lock:
+            contact = self._contacts.pop(key, None)
+            if contact is not None:
+                self.hits += 1
+                self._contacts[key] = contact
+                return contact
+            self.misses += 1
+        contact = FrozenContact(*key)
+        contact.encode(self.dumps)
+        with self._lock:
+            contact = self._contacts.setdefault(key, contact)
+            while len(self._contacts) > self.max_size:
+                self._contacts.popitem(last=False)
+        return contact
+
+    def intern(self, contact):
+        """Returns the shared `FrozenContact` with the fields of the given
+        contact."""
+        return self.get(*[getattr(contact, field) for field in self.FIELDS])
+
+    def __len__(self):
+        return len(self._contacts)
+
+
+class _Placeholder(object):
+    def __init__(self, value):
+        self.json = value
+
+
+def _placeholder(field):
+    return '\x01verkkomaksut:%s\x01' % field
+
+
+def _split_encoded(encoded, tokens):
+    """Splits `encoded` at the encoded placeholders in the `tokens` dict,
+    which maps field names to them.  Returns the constant parts and the
+    fields between them in order."""
+    positions = []
+    for field, token in tokens.items():
+        index = encoded.find(token)
+        if index < 0 or encoded.find(token, index + 1) >= 0:
+            raise ValueError('Cannot pre-encode the payment JSON.')
+        positions.append((index, field, len(token)))
+    positions.sort()
+    parts = []
+    fields = []
+    start = 0
+    for index, field, length in positions:
+        parts.append(encoded[start:index])
+        fields.append(field)
+        start = index + length
+    parts.append(encoded[start:])
+    return parts, fields
+
+
+def _model_skeleton(cls, fields, dumps):
+    model = cls.__new__(cls)
+    for field in fields:
+        model.__dict__[field] = _placeholder(field)
+    tokens = dict((field, dumps(_placeholder(field))) for field in fields)
+    return _split_encoded(dumps(model._build_json()), tokens)
+
+
+def _format_string(parts):
+    """Joins the constant parts of a skeleton into a ``%`` format string
+    with a ``%s`` between each of them."""
+    if bytes is not str and isinstance(parts[0], bytes):
+        percent = b'%'
+        slot = b'%s'
+    else:
+        percent = '%'
+        slot = '%s'
+    return slot.join([part.replace(percent, percent * 2) for part in parts])
+
+
+def _scalar_encoder(dumps):
+    """Returns a function encoding a single JSON value like `dumps`.  For the
+    default codec strings and integers are encoded directly, without the
+    overhead of a `json.dumps` call."""
+    if dumps is not _json_dumps:
+        return dumps
+
+    from json.encoder import encode_basestring_ascii
+    encoders = {
+        type(u''): encode_basestring_ascii,
+        type(''): encode_basestring_ascii,
+        int: int.__repr__,
+        type(None): lambda value: 'null',
+        bool: lambda value: 'true' if value else 'false',
+    }
+
+    def encode(value):
+        try:
+            return encoders[type(value)](value)
+        except KeyError:
+            return dumps(value)
+    return encode
+
+
+class _Skeleton(object):
+    """The pre-encoded payment, contact and product JSON for one `dumps`
+    function, as ``%`` format strings."""
+
+    PAYMENT_FIELDS = (
+        'order_number', 'reference_number', 'description', 'contact',
+        '_products'
+    )
+    CONTACT_FIELDS = (
+        'telephone', 'mobile', 'email', 'first_name', 'last_name',
+        'company_name', 'street', 'postal_code', 'postal_office', 'country'
+    )
+    PRODUCT_FIELDS = (
+        'title', 'code', 'amount', 'price', 'vat', 'discount', '_type'
+    )
+
+    #: Longer product lists are encoded faster by `dumps` than by filling in
+    #: the product format string row by row.
+    MAX_FORMATTED_PRODUCTS = 10
+
+    def __init__(self, prototype, dumps):
+        payment = Payment.__new__(Payment)
+        payment.__dict__.update(prototype.__dict__)
+        for field in self.PAYMENT_FIELDS:
+            payment.__dict__[field] = _placeholder(field)
+        payment.__dict__['contact'] = _Placeholder(_placeholder('contact'))
+        payment.__dict__['_products'] = _Placeholder(
+            _placeholder('_products')
+        )
+        tokens = dict(
+            (field, dumps(_placeholder(field)))
+            for field in self.PAYMENT_FIELDS
+        )
+        parts, self.payment_fields = _split_encoded(
+            dumps(payment._build_json()), tokens
+        )
+        self.payment_format = _format_string(parts)
+
+        parts, fields = _model_skeleton(Contact, self.CONTACT_FIELDS, dumps)
+        self.contact_format = _format_string(parts)
+        self.contact_values = attrgetter(*fields)
+
+        parts, fields = _model_skeleton(Product, self.PRODUCT_FIELDS, dumps)
+        self.product_format = _format_string(parts)
+        self.product_values = attrgetter(*fields)
+
+        items = [_placeholder('first'), _placeholder('second')]
+        parts, _ = _split_encoded(dumps(items), {
+            'first': dumps(items[0]), 'second': dumps(items[1])
+        })
+        self.list_start, self.list_separator, self.list_end = parts
+        self.empty_list = dumps([])
+        self.encode_value = _scalar_encoder(dumps)
+        self.dumps = dumps
+
+    def encode_payment(self, payment):
+        values = []
+        for field in self.payment_fields:
+            if field == 'contact':
+                values.append(self.encode_contact(payment.contact))
+            elif field == '_products':
+                values.append(self.encode_products(payment.products))
+            else:
+                values.append(self.encode_value(getattr(payment, field)))
+        return self.payment_format % tuple(values)
+
+    def encode_contact(self, contact):
+        if type(contact) in (Contact, CompactContact):
+            encode = self.encode_value
+            return self.contact_format % tuple([
+                encode(value) for value in self.contact_values(contact)
+            ])
+        encode = getattr(contact, 'encode', None)
+        if encode is not None:
+            return encode(self.dumps)
+        return self.dumps(contact.json)
+
+    def encode_products(self, products):
+        if (not isinstance(products, ProductList) or
+                len(products) > self.MAX_FORMATTED_PRODUCTS):
+            return self.dumps(products.json)
+        if not products:
+            return self.empty_list
+        encode = self.encode_value
+        product_format = self.product_format
+        product_values = self.product_values
+        rows = []
+        for product in products:
+            if type(product) not in (Product, CompactProduct):
+                return self.dumps(products.json)
+            rows.append(product_format % tuple([
+                encode(value) for value in product_values(product)
+            ]))
+        return self.list_start + self.list_separator.join(rows) + \
+            self.list_end
+
+
+class PaymentTemplate(object):
+    """Pre-encodes the JSON structure of payments that share their URLs,
+    `currency`, `locale` and `include_vat`.  Payments created with `payment`
+    are encoded by filling in only their order number, reference number,
+    description, contact and products, without building the JSON
+    representation and encoding it in full::
+
+        template = PaymentTemplate(
+            success_url='https://www.esimerkkikauppa.fi/sv/success',
+            failure_url='https://www.esimerkkikauppa.fi/sv/failure',
+            notification_url='https://www.esimerkkikauppa.fi/sv/notify'
+        )
+        payment = template.payment('12345', contact, products)
+        client.create_payment(payment)
+
+    The payments are ordinary `Payment` objects, and are encoded to the same
+    request body as other payments.  If one of the constant fields of a
+    payment is changed, it is encoded in full as usual.
+
+    The arguments are the same as for `Payment`, except for those given to
+    `payment`.
+    """
+
+    def __init__(self, success_url, failure_url, notification_url,
+                 **options):
+        self._prototype = Payment(
+            None, None, success_url, failure_url, notification_url, **options
+        )
+        self._constants = _payment_constants(self._prototype)
+        self._skeletons = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_skeletons']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._skeletons = {}
+
+    def payment(self, order_number, contact, products=(),
+                reference_number=None, description=None):
+        """Returns a new `Payment` using this template."""
+        payment = self._create(
+            _TemplatePayment, order_number, contact, products,
+            reference_number, description
+        )
+        _set(payment, '_template', self)
+        return payment
+
+    def _create(self, cls, order_number, contact, products, reference_number,
+                description):
+        prototype = self._prototype
+        payment = cls(
+            order_number, contact,
+            prototype.success_url,
+            prototype.failure_url,
+            prototype.notification_url,
+            reference_number=reference_number,
+            description=description,
+            currency=prototype.currency,
+            locale=prototype.locale,
+            include_vat=prototype.include_vat,
+            pending_url=prototype.pending_url
+        )
+        payment.products = products
+        return payment
+
+    def encode(self, payment, dumps=None):
+        """Returns the request body of `payment`, which must have the
+        constant fields of this template, encoded with `dumps`.  If `dumps`
+        does not encode the pre-encoded parts the same way wherever they
+        appear, for example because it indents its output, the payment is
+        encoded in full."""
+        if dumps is None:
+            dumps = _json_dumps
+        skeleton = self._skeletons.get(dumps, _missing)
+        if skeleton is _missing:
+            skeleton = self._skeletons[dumps] = self._build_skeleton(dumps)
+        if skeleton is None:
+            return dumps(payment.json)
+        return skeleton.encode_payment(payment)
+
+    def _build_skeleton(self, dumps):
+        try:
+            skeleton = _Skeleton(self._prototype, dumps)
+        except ValueError:
+            return None
+        sample = self._create(
+            Payment,
+            '1',
+            Contact('Matti', 'Meikalainen', 'matti@example.com',
+                    'Esimerkkikatu 123', '01234', 'Helsinki', 'FI',
+                    mobile='0401234567'),
+            [Product('Tuote', '19.90', 23, amount=2),
+             Product('Toimitus', 4.9, '23.00', type=Product.TYPE_POSTAGE)],
+            None,
+            '"Tilaus"\n'
+        )
+        if skeleton.encode_payment(sample) != dumps(sample.json):
+            return None
+        return skeleton
+
+
+def _payment_constants(payment):
+    return (
+        payment.success_url, payment.failure_url, payment.pending_url,
+        payment.notification_url, payment.currency, payment.locale,
+        payment.include_vat
+    )
+
+
+class _TemplatePayment(Payment):
+    _transient = Payment._transient | frozenset(['_template_cache'])
+
+    def encode(self, dumps=None):
+        template = self.__dict__.get('_template')
+        if (template is None or
+                _payment_constants(self) != template._constants):
+            return super(_TemplatePayment, self).encode(dumps)
+        if dumps is None:
+            dumps = _json_dumps
+        stamp = self._stamp()
+        cache = self.__dict__.get('_template_cache')
+        if stamp is not None and cache is not None and \
+                cache[0] == stamp and cache[1] is dumps:
+            return cache[2]
+        body = template.encode(self, dumps)
+        if stamp is not None:
+            self.__dict__['_template_cache'] = (stamp, dumps, body)
+        return body
+
+
+class ReceiptValidator(object):
+    """Validates the authcodes of the payment receipts Suomen Verkkomaksut
+    sends to the success, failure, pending and notification URLs.
+
+    The validator is built once per merchant secret so that the per-receipt
+    work is limited to hashing the receipt parameters.  Authcodes are compared
+    in constant time and case-insensitively.
+    """
+
+    def __init__(self, merchant_secret):
+        self.merchant_secret = merchant_secret
+        self._suffix = _to_bytes('|' + merchant_secret)
+
+    def digest(self, *params):
+        """Returns the raw MD5 digest of the given receipt parameters and the
+        merchant secret."""
+        hash_ = hashlib.md5(_to_bytes('|'.join(params)))
+        hash_.update(self._suffix)
+        return hash_.digest()
+
+    def calculate_hash(self, *params):
+        """Returns the authcode of the given receipt parameters as an
+        uppercase hexadecimal string, as calculated by Suomen Verkkomaksut."""
+        return binascii.hexlify(self.digest(*params)).decode('ascii').upper()
+
+    def validate(self, authcode, *params):
+        """Returns `True` if `authcode` is the authcode of the given receipt
+        parameters, and `False` otherwise."""
+        try:
+            expected = binascii.unhexlify(authcode)
+        except (TypeError, ValueError):
+            return False
+        return hmac.compare_digest(self.digest(*params), expected)
+
+    def validate_many(self, authcodes, *columns):
+        """Validates many receipts at once.  `authcodes` and each of the
+        `columns` are parallel iterables, so that the ``i``-th receipt
+        consists of the ``i``-th item of each of them.  Returns a `bytearray`
+        holding 1 for each valid receipt and 0 for each invalid one."""
+        validate = self.validate
+        return bytearray(
+            validate(*receipt) for receipt in zip(authcodes, *columns)
+        )
+
+    def validate_successful_payment(self, authcode, order_number, timestamp,
+                                   paid, method):
+        """Same as `Client.validate_successful_payment`."""
+        return self.validate(authcode, order_number, timestamp, paid, method)
+
+    def validate_failed_payment(self, authcode, order_number, timestamp):
+        """Same as `Client.validate_failed_payment`."""
+        return self.validate(authcode, order_number, timestamp)
+
+
+def _to_bytes(value):
+    if isinstance(value, bytes):
+        return value
+    return value.encode('utf-8')
+
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _validate_receipt_chunk(args):
+    merchant_secret, receipts = args
+    validate = ReceiptValidator(merchant_secret).validate
+    return bytearray(validate(*receipt) for receipt in receipts)
+
+
+class JSONCodec(object):
+    """Encodes the request bodies and decodes the response bodies of the API.
+
+    The standard library `json` module is used by default.  A faster JSON
+    library can be plugged in by passing its functions, for example::
+
+        import orjson
+        client = Client(codec=JSONCodec(orjson.dumps, orjson.loads))
+
+    `dumps` may return either text or bytes; bytes are sent as is.
+    """
+
+    def __init__(self, dumps=None, loads=None):
+        self.dumps = dumps or _json_dumps
+        self.loads = loads or _json_loads
+
+
+def _json_dumps(obj):
+    import json
+    return json.dumps(obj)
+
+
+def _json_loads(s):
+    import json
+    return json.loads(s)
+
+
+_default_codec = JSONCodec()
+
+
+def _limit_timeout(timeout, remaining):
+    remaining = max(remaining, 0.001)
+    if timeout is None:
+        return remaining
+    if isinstance(timeout, tuple):
+        return tuple(
+            remaining if part is None else min(part, remaining)
+            for part in timeout
+        )
+    return min(timeout, remaining)
+
+
+_clock = getattr(time, 'perf_counter', time.time)
+
+
+def _connection_error():
+    from requests import ConnectionError
+    return ConnectionError
+
+
+class _Measurement(object):
+    """Collects the `RequestMetrics` of one API call phase by phase."""
+
+    def __init__(self, payment):
+        self.payment = payment
+        self.timings = [0.0, 0.0, 0.0, 0.0]
+        self.phase = 0
+        self.body = b''
+        self.status_code = None
+        self.error_code = None
+        self._mark = _clock()
+
+    def next_phase(self):
+        now = _clock()
+        self.timings[self.phase] = now - self._mark
+        self._mark = now
+        self.phase += 1
+
+    def fail(self, exc):
+        if isinstance(exc, VerkkomaksutException):
+            self.error_code = exc.code
+        else:
+            self.error_code = type(exc).__name__
+
+    def finish(self):
+        self.next_phase()
+        return RequestMetrics(
+            getattr(self.payment, 'order_number', None),
+            *self.timings,
+            payload_size=len(self.body),
+            product_count=len(getattr(self.payment, 'products', ())),
+            status_code=self.status_code,
+            error_code=self.error_code
+        )
+
+
+class BaseClient(object):
+    """Functionality shared by the blocking `Client` and the asyncio based
+    :class:`verkkomaksut.aio.AsyncClient`: merchant credentials, API response
+    handling and validation of payment receipts."""
+
     SERVICE_URL = "https://payment.verkkomaksut.fi/api-payment/create"
 
+    #: HTTP headers sent with every request to the API.
+    HEADERS = {
+        'Accept': 'application/json',
+        'Content-Type': 'application/json',
+        'X-Verkkomaksut-Api-Version': '1'
+    }
+
     def __init__(self, merchant_id='13466',
-                       merchant_secret='6pKF4jkv97zmqBJ3ZL8gUw5DfT2NMQ'):
+                       merchant_secret='6pKF4jkv97zmqBJ3ZL8gUw5DfT2NMQ',
+                       codec=None, rate_limiter=None, circuit_breaker=None,
+                       metrics=None, replay_cache=None, max_receipt_age=None):
         """
         Initialize the client with your own merchant id and merchant secret.
 
@@ -276,36 +1362,81 @@ class Client(object):
             when you make the contract. Default is the test merchant account.
         :param merchant_secret: Merchant secret is given to you by Suoment
             Verkkomaksut. Default is the test merchant account.
+        :param codec: a `JSONCodec` used for encoding request bodies and
+            decoding response bodies. Default uses the `json` module.
+        :param rate_limiter: a `RateLimiter` limiting the rate and
+            concurrency of requests to the API.  The same limiter can be
+            shared by many clients.  Default is no limits.
+        :param circuit_breaker: a `CircuitBreaker` that makes payment
+            creation fail fast with the ``circuit-open`` error code while the
+            API is failing.  Default is no circuit breaker.
+        :param metrics: a metrics sink, such as a `HistogramRecorder`, whose
+            ``record`` method is called with the `RequestMetrics` of every
+            payment created.  Default is no instrumentation.
+        :param replay_cache: a cache of accepted receipts from
+            `verkkomaksut.replay`.  If given, `validate_successful_payment`
+            and `validate_failed_payment` accept each receipt only once.
+        :param max_receipt_age: If given, receipts whose timestamp differs
+            from the current time by more than this many seconds are
+            rejected.
         """
         self.merchant_id = merchant_id
         self.merchant_secret = merchant_secret
-        self.session = requests.Session()
-        self.session.auth = (merchant_id, merchant_secret)
-        self.session.headers = {
-            'Accept': 'application/json',
-            'Content-Type': 'application/json',
-            'X-Verkkomaksut-Api-Version': '1'
-        }
+        self.codec = codec or _default_codec
+        self.rate_limiter = rate_limiter
+        self.circuit_breaker = circuit_breaker
+        self.metrics = metrics
+        self.replay_cache = replay_cache
+        self.max_receipt_age = max_receipt_age
 
-    def create_payment(self, payment):
-        """Creates a new payment and returns a `dict` with the following data:
-        `orderNumber`
+    @property
+    def merchant_secret(self):
+        return self._merchant_secret
 
-        :param payment: a `Payment` object
+    @merchant_secret.setter
+    def merchant_secret(self, value):
+        self._merchant_secret = value
 
-        """
-        response = self.session.post(self.SERVICE_URL,
-            data=json.dumps(payment.json)
-        )
+        #: The `ReceiptValidator` used for validating payment receipts with
+        #: the merchant secret of this client.
+        self.receipt_validator = ReceiptValidator(value)
 
-        if response.status_code != requests.codes.created:
-            data = json.loads(response.content)
+    def _check_circuit(self):
+        breaker = self.circuit_breaker
+        if breaker is not None and not breaker.allow():
+            raise VerkkomaksutException(
+                code='circuit-open',
+                message='The payment API is failing; request not sent.'
+            )
+
+    def _record_metrics(self, measurement):
+        self.metrics.record(measurement.finish())
+
+    def _check_payment(self, payment):
+        validate = getattr(payment, 'validate', None)
+        if validate is not None:
+            validate()
+
+    def _encode_payment(self, payment):
+        encode = getattr(payment, 'encode', None)
+        if encode is not None:
+            return encode(self.codec.dumps)
+        return self.codec.dumps(payment.json)
+
+    def _handle_response(self, status_code, content):
+        try:
+            data = self.codec.loads(content)
+        except ValueError:
+            raise VerkkomaksutException(
+                code='invalid-response',
+                message='Invalid response from the API (HTTP status %d).'
+                        % status_code
+            )
+        if status_code != 201:
             raise VerkkomaksutException(
                 code=data['errorCode'],
                 message=data['errorMessage']
             )
-
-        data = json.loads(response.content)
         return {
             'order_number': data['orderNumber'],
             'token': data['token'],
@@ -313,12 +1444,29 @@ class Client(object):
         }
 
     def _calculate_payment_receipt_hash(self, *params):
-        base = '|'.join(params + (self.merchant_secret,))
-        return hashlib.md5(base).hexdigest().upper()
+        return self.receipt_validator.calculate_hash(*params)
 
     def _validate_payment_receipt_parameters(self, authcode, *params):
-        hash_ = self._calculate_payment_receipt_hash(*params)
-        return authcode == hash_
+        return self.receipt_validator.validate(authcode, *params)
+
+    def _accept_receipt(self, authcode, order_number, timestamp, *params):
+        if not self._validate_payment_receipt_parameters(
+                authcode, order_number, timestamp, *params):
+            return False
+        return self._admit_receipt(order_number, timestamp, *params)
+
+    def _admit_receipt(self, order_number, timestamp, *params):
+        if self.max_receipt_age is not None:
+            try:
+                age = abs(time.time() - int(timestamp))
+            except (TypeError, ValueError):
+                return False
+            if age > self.max_receipt_age:
+                return False
+        if self.replay_cache is not None:
+            key = (order_number, timestamp) + params[:1]
+            return self.replay_cache.add(key)
+        return True
 
     def validate_successful_payment(self, authcode, order_number, timestamp,
                                    paid, method):
@@ -337,8 +1485,13 @@ class Client(object):
             confirmation. In case of a pending payment, this parameter is
             always "0000000000".
         :param method: The payment method used.
+
+        With the `replay_cache` option, a receipt is accepted only once, so
+        when both the success URL and the notification URL receive it, only
+        the first one is valid.  With the `max_receipt_age` option, stale
+        receipts are rejected.
         """
-        return self._validate_payment_receipt_parameters(
+        return self._accept_receipt(
             authcode, order_number, timestamp, paid, method
         )
 
@@ -352,7 +1505,447 @@ class Client(object):
             the payment system. Order number uniquely identifies each payment.
         :param timestamp: A Unix timestamp produced by Suomen Verkkomaksut used
             for calculating the hash.
+
+        The `replay_cache` and `max_receipt_age` options apply as in
+        `validate_successful_payment`.
+        """
+        return self._accept_receipt(authcode, order_number, timestamp)
+
+    def verify_receipt(self, params):
+        """
+        Validates the query parameters Suomen Verkkomaksut sent to the
+        success, failure, pending or notification URL, given as a mapping
+        such as ``request.args``.  Returns a `Receipt` if the parameters are
+        valid, and `None` otherwise.  The `replay_cache` and
+        `max_receipt_age` options apply as in `validate_successful_payment`.
+
+        :param params: A mapping with the ``RETURN_AUTHCODE``,
+            ``ORDER_NUMBER`` and ``TIMESTAMP`` parameters, and the ``PAID``
+            and ``METHOD`` parameters of a successful payment.
+        """
+        authcode, receipt = _parse_receipt(params)
+        if receipt is None:
+            return None
+        if not self._accept_receipt(authcode, *receipt.params):
+            return None
+        return receipt
+
+    def validate_receipts(self, authcodes, order_numbers, timestamps,
+                          paids=None, methods=None, processes=None,
+                          chunk_size=10000):
         """
-        return self._validate_payment_receipt_parameters(
-            authcode, order_number, timestamp
+        Validates a batch of receipts given as parallel columns, for example
+        rows of archived success or notification requests or the fields of a
+        NumPy structured array.  Returns a `bytearray` with one item for each
+        receipt: 1 if the receipt is valid, and 0 otherwise.
+
+        Successful payments are validated when `paids` and `methods` are
+        given, and failed payments when they are omitted.
+
+        :param authcodes: Hash values calculated by payment system.
+        :param order_numbers: The order numbers of the receipts.
+        :param timestamps: The timestamps of the receipts.
+        :param paids: The payment codes of successful payments.
+        :param methods: The payment methods of successful payments.
+        :param processes: If given, the receipts are validated in chunks of
+            `chunk_size` receipts by a pool of this many worker processes.
+            This pays off only for very large batches.
+        :param chunk_size: The number of receipts sent to a worker process at
+            a time.
+        """
+        if (paids is None) != (methods is None):
+            raise ValueError('paids and methods must be given together.')
+        columns = (order_numbers, timestamps)
+        if paids is not None:
+            columns += (paids, methods)
+
+        if not processes:
+            return self.receipt_validator.validate_many(authcodes, *columns)
+
+        import multiprocessing
+        chunks = (
+            (self.merchant_secret, chunk)
+            for chunk in _chunks(zip(authcodes, *columns), chunk_size)
         )
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = bytearray()
+            for result in pool.imap(_validate_receipt_chunk, chunks):
+                results += result
+        finally:
+            pool.terminate()
+            pool.join()
+        return results
+
+
+class Client(BaseClient):
+    def __init__(self, merchant_id='13466',
+                       merchant_secret='6pKF4jkv97zmqBJ3ZL8gUw5DfT2NMQ',
+                       timeout=None, retry=None, pool_connections=10,
+                       pool_maxsize=10, pool_block=False, keep_alive=True,
+                       adapter=None, **options):
+        """
+        Initialize the client with your own merchant id and merchant secret.
+        See `BaseClient` for the other available options.
+
+        A client can be shared by all threads of a multi-threaded server.
+        Each thread sends its requests with its own `session` over the
+        shared connection pool of the client.
+
+        :param timeout: The timeout of each request attempt in seconds, or a
+            ``(connect timeout, read timeout)`` tuple.  Default is no timeout.
+        :param retry: a `RetryPolicy` for retrying requests that fail because
+            of connection errors or server errors.  Default is no retries.
+        :param pool_connections: The number of hosts to keep connection pools
+            for.
+        :param pool_maxsize: The maximum number of connections kept open to
+            the API.  Set this to the number of threads creating payments.
+        :param pool_block: If `True`, requests wait for a free connection
+            when all `pool_maxsize` connections are in use, instead of
+            opening an extra connection.
+        :param keep_alive: If `False`, every connection is closed after one
+            request.
+        :param adapter: A `verkkomaksut.adapters.PoolAdapter` to use instead
+            of creating a new one, for sharing a connection pool between
+            clients.  The pool options are ignored when it is given.
+        """
+        super(Client, self).__init__(merchant_id, merchant_secret, **options)
+        self.timeout = timeout
+        self.retry = retry
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.pool_block = pool_block
+        self.keep_alive = keep_alive
+        self._adapter = adapter
+        self._session = None
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    @property
+    def adapter(self):
+        """The `verkkomaksut.adapters.PoolAdapter` holding the connection
+        pool of this client.  It is created on first use, and shared by the
+        sessions of all threads."""
+        if self._adapter is None:
+            with self._lock:
+                if self._adapter is None:
+                    from .adapters import PoolAdapter
+                    self._adapter = PoolAdapter(
+                        pool_connections=self.pool_connections,
+                        pool_maxsize=self.pool_maxsize,
+                        pool_block=self.pool_block
+                    )
+        return self._adapter
+
+    @property
+    def session(self):
+        """The `requests.Session` used for API requests in the current
+        thread.  Each thread gets its own session on first use, mounted on
+        the shared `adapter`, so a client can be used by many threads at
+        once and they share the connection pool but not the state of the
+        session.  The sessions are created lazily, so that ``requests`` is
+        not imported by applications that only validate receipts.
+
+        A session assigned to this attribute is used by all threads
+        instead, and must be safe for that.
+        """
+        if self._session is not None:
+            return self._session
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = self._create_session()
+        elif session.auth != (self.merchant_id, self.merchant_secret):
+            session.auth = (self.merchant_id, self.merchant_secret)
+        return session
+
+    @session.setter
+    def session(self, value):
+        self._session = value
+
+    def _create_session(self):
+        import requests
+        session = requests.Session()
+        session.mount('https://', self.adapter)
+        session.mount('http://', self.adapter)
+        session.auth = (self.merchant_id, self.merchant_secret)
+        session.headers = dict(self.HEADERS)
+        if not self.keep_alive:
+            session.headers['Connection'] = 'close'
+        return session
+
+    def pool_stats(self):
+        """Returns a `dict` with the number of `active`, `idle` and `waiting`
+        connections in the connection pool of this client.  See
+        `PoolAdapter.stats`."""
+        return self.adapter.stats()
+
+    def create_payment(self, payment):
+        """Creates a new payment and returns a `dict` with the following data:
+        `orderNumber`
+
+        :param payment: a `Payment` object
+
+        """
+        if self.metrics is not None:
+            return self._create_payment_measured(payment)
+        self._check_payment(payment)
+        body = self._encode_payment(payment)
+        response = self._send(body)
+        return self._handle_response(response.status_code, response.content)
+
+    def _create_payment_measured(self, payment):
+        measurement = _Measurement(payment)
+        try:
+            self._check_payment(payment)
+            measurement.next_phase()
+            body = measurement.body = self._encode_payment(payment)
+            measurement.next_phase()
+            response = self._send(body)
+            measurement.status_code = response.status_code
+            measurement.next_phase()
+            return self._handle_response(
+                response.status_code, response.content
+            )
+        except Exception as exc:
+            measurement.fail(exc)
+            raise
+        finally:
+            self._record_metrics(measurement)
+
+    def _send(self, body):
+        if self.retry is None:
+            return self._post(body, self.timeout)
+        return self._post_with_retry(body)
+
+    def _post(self, body, timeout):
+        limiter = self.rate_limiter
+        breaker = self.circuit_breaker
+        if limiter is None and breaker is None:
+            return self.session.post(self.SERVICE_URL,
+                data=body,
+                timeout=timeout
+            )
+
+        permit = limiter.acquire() if limiter is not None else None
+        try:
+            self._check_circuit()
+            started = time.time()
+            failed = True
+            try:
+                response = self.session.post(self.SERVICE_URL,
+                    data=body,
+                    timeout=timeout
+                )
+                failed = response.status_code >= 500
+                return response
+            finally:
+                if breaker is not None:
+                    breaker.record(failed, time.time() - started)
+        finally:
+            if limiter is not None:
+                limiter.release(permit)
+
+    def _post_with_retry(self, body):
+        retry = self.retry
+        deadline = retry.start()
+        attempt = 1
+        while True:
+            timeout = self.timeout
+            if deadline is not None:
+                timeout = _limit_timeout(timeout, deadline - time.time())
+            try:
+                response = self._post(body, timeout)
+            except _connection_error():
+                delay = retry.next_delay(attempt, deadline)
+                if delay is None:
+                    raise
+            else:
+                if not retry.is_retryable_status(response.status_code):
+                    return response
+                delay = retry.next_delay(attempt, deadline)
+                if delay is None:
+                    return response
+            time.sleep(delay)
+            attempt += 1
+
+    def create_payments(self, payments, max_concurrency=10, ordered=True):
+        """Creates many payments concurrently and yields a `PaymentResult`
+        for each of them as soon as it is available.
+
+        At most `max_concurrency` payments are in flight or waiting to be
+        consumed at any time, and `payments` is consumed lazily, so a large
+        generator of payments can be processed in constant memory.  A payment
+        that fails does not abort the batch; the exception is returned in
+        the `error` attribute of its result instead.
+
+        :param payments: an iterable of `Payment` objects
+        :param max_concurrency: the maximum number of simultaneous requests
+            to the API.
+        :param ordered: if `True`, results are yielded in the order of
+            `payments`; otherwise they are yielded in completion order.
+        :raises ValueError: if `max_concurrency` is less than 1.
+        """
+        if max_concurrency < 1:
+            raise ValueError('max_concurrency must be at least 1.')
+        return self._create_payments(payments, max_concurrency, ordered)
+
+    def _create_payments(self, payments, max_concurrency, ordered):
+        payments = enumerate(payments)
+        lock = threading.Lock()
+        slots = threading.Semaphore(max_concurrency)
+        results = Queue()
+        stopped = threading.Event()
+        failures = []
+
+        def work():
+            while True:
+                slots.acquire()
+                with lock:
+                    if stopped.is_set():
+                        break
+                    try:
+                        index, payment = next(payments)
+                    except StopIteration:
+                        break
+                    except Exception as exc:
+                        failures.append(exc)
+                        break
+                try:
+                    result = PaymentResult(
+                        payment, self.create_payment(payment), None
+                    )
+                except Exception as exc:
+                    result = PaymentResult(payment, None, exc)
+                results.put((index, result))
+            results.put(None)
+
+        workers = [
+            threading.Thread(target=work) for _ in range(max_concurrency)
+        ]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+
+        running = len(workers)
+        buffered = {}
+        next_index = 0
+        try:
+            while running:
+                item = results.get()
+                if item is None:
+                    running -= 1
+                    continue
+                index, result = item
+                if not ordered:
+                    slots.release()
+                    yield result
+                    continue
+                buffered[index] = result
+                while next_index in buffered:
+                    slots.release()
+                    yield buffered.pop(next_index)
+                    next_index += 1
+        finally:
+            stopped.set()
+            for worker in workers:
+                slots.release()
+
+        if failures:
+            raise failures[0]
+
+
+class ClientRegistry(object):
+    """Hands out a `Client` for each merchant, for applications that create
+    payments on behalf of many merchants.
+
+    All clients share one `PoolAdapter`, so connections to the API are
+    reused across merchants.  Each client keeps its `ReceiptValidator`, so
+    the merchant secret is keyed only once.  At most `max_clients` clients
+    are kept; the least recently used one is dropped when a new merchant
+    is added.  Dropped clients do not close the shared connections, so the
+    sessions of the clients must not be closed either; use `close` to close
+    the registry instead::
+
+        registry = ClientRegistry(max_clients=500, timeout=(3.05, 10))
+        client = registry.get(shop.merchant_id, shop.merchant_secret)
+        client.create_payment(payment)
+
+    :param max_clients: The maximum number of clients kept.
+    :param pool_connections: See `Client`.
+    :param pool_maxsize: See `Client`.
+    :param pool_block: See `Client`.
+    :param options: Other options passed to every `Client`, such as
+        `timeout`, `retry` or `rate_limiter`.
+    """
+
+    #: The class of the clients created.
+    client_class = Client
+
+    def __init__(self, max_clients=100, pool_connections=10, pool_maxsize=10,
+                 pool_block=False, **options):
+        self.max_clients = max_clients
+        self.options = options
+
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.pool_block = pool_block
+        self._adapter = None
+        self._clients = OrderedDict()
+        self._lock = threading.Lock()
+        self._adapter_lock = threading.Lock()
+
+    @property
+    def adapter(self):
+        """The `verkkomaksut.adapters.PoolAdapter` shared by all clients of
+        this registry.  It is created on first use."""
+        with self._adapter_lock:
+            if self._adapter is None:
+                from .adapters import PoolAdapter
+                self._adapter = PoolAdapter(
+                    pool_connections=self.pool_connections,
+                    pool_maxsize=self.pool_maxsize,
+                    pool_block=self.pool_block
+                )
+            return self._adapter
+
+    def get(self, merchant_id, merchant_secret):
+        """Returns the client of the given merchant, creating it if needed.
+        If the merchant secret has changed, the client is updated to use the
+        new one."""
+        with self._lock:
+            client = self._clients.pop(merchant_id, None)
+            if client is None:
+                client = self.client_class(
+                    merchant_id, merchant_secret,
+                    adapter=self.adapter,
+                    **self.options
+                )
+            elif client.merchant_secret != merchant_secret:
+                client.merchant_secret = merchant_secret
+            self._clients[merchant_id] = client
+            while len(self._clients) > self.max_clients:
+                self._clients.popitem(last=False)
+            return client
+
+    def remove(self, merchant_id):
+        """Drops the client of the given merchant, if any."""
+        with self._lock:
+            self._clients.pop(merchant_id, None)
+
+    def close(self):
+        """Drops all clients and closes the shared connections."""
+        with self._lock:
+            self._clients.clear()
+        if self._adapter is not None:
+            self._adapter.close()
+
+    def pool_stats(self):
+        """Returns the statistics of the shared connection pool.  See
+        `PoolAdapter.stats`."""
+        return self.adapter.stats()
+
+    def __len__(self):
+        return len(self._clients)
+
+    def __contains__(self, merchant_id):
+        return merchant_id in self._clients
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+    verkkomaksut.adapters
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    Transport adapters used by `Client` for talking to the Suomen
+    Verkkomaksut API.
+
+    :copyright: (c) 2013 by Janne Vanhala.
+    :license: BSD, see LICENSE for more details.
+"""
+import threading
+
+from requests.adapters import HTTPAdapter
+
+
+class PoolAdapter(HTTPAdapter):
+    """An `HTTPAdapter` that keeps count of the requests passing through it,
+    so that the saturation of its connection pools can be monitored with
+    `stats`.
+
+    :param pool_connections: The number of hosts to keep connection pools
+        for.
+    :param pool_maxsize: The maximum number of connections kept open to each
+        host.
+    :param pool_block: If `True`, requests wait for a free connection when
+        all `pool_maxsize` connections are in use.  If `False`, an extra
+        connection is opened and closed after the request.
+    """
+
+    def __init__(self, pool_connections=10, pool_maxsize=10,
+                 pool_block=False, **kwargs):
+        self._sending = 0
+        self._sending_lock = threading.Lock()
+        super(PoolAdapter, self).__init__(
+            pool_connections=pool_connections,
+            pool_maxsize=pool_maxsize,
+            pool_block=pool_block,
+            **kwargs
+        )
+
+    def __setstate__(self, state):
+        super(PoolAdapter, self).__setstate__(state)
+        self._sending = 0
+        self._sending_lock = threading.Lock()
+
+    def send(self, request, *args, **kwargs):
+        with self._sending_lock:
+            self._sending += 1
+        try:
+            return super(PoolAdapter, self).send(request, *args, **kwargs)
+        finally:
+            with self._sending_lock:
+                self._sending -= 1
+
+    def stats(self):
+        """Returns a `dict` with the number of `active` connections in use by
+        requests, `idle` connections kept open for reuse and requests
+        `waiting` for a free connection, summed over all pools.
+
+        The numbers are a snapshot taken without locking the pools, so they
+        are approximate while requests are in progress.
+        """
+        active = idle = 0
+        pools = self.poolmanager.pools
+        for key in list(pools.keys()):
+            try:
+                pool = pools[key]
+            except KeyError:
+                continue
+            if pool.pool is None:
+                continue
+            free = list(pool.pool.queue)
+            active += pool.pool.maxsize - len(free)
+            idle += sum(1 for conn in free if conn is not None)
+        sending = self._sending
+        if self._pool_block:
+            waiting = max(0, sending - active)
+        else:
+            active = max(active, sending)
+            waiting = 0
+        return {'active': active, 'idle': idle, 'waiting': waiting}
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""
+    verkkomaksut.aio
+    ~~~~~~~~~~~~~~~~
+
+    Asyncio client for the JSON API of Suomen Verkkomaksut.
+
+    This module requires Python 3.5 or newer and `aiohttp`_, which can be
+    installed with ``pip install verkkomaksut[async]``.
+
+    .. _aiohttp: https://docs.aiohttp.org/
+
+    :copyright: (c) 2013 by Janne Vanhala.
+    :license: BSD, see LICENSE for more details.
+"""
+import asyncio
+import time
+
+import aiohttp
+
+from . import BaseClient, _Measurement
+
+
+class AsyncClient(BaseClient):
+    """Asyncio counterpart of `Client`.
+
+    All payments created through one `AsyncClient` share a single pool of
+    keep-alive connections, so hundreds of payments can be created
+    concurrently from one event loop::
+
+        async with AsyncClient(merchant_id, merchant_secret) as client:
+            results = await asyncio.gather(
+                *[client.create_payment(payment) for payment in payments]
+            )
+    """
+
+    def __init__(self, merchant_id='13466',
+                       merchant_secret='6pKF4jkv97zmqBJ3ZL8gUw5DfT2NMQ',
+                       max_connections=100, **options):
+        """
+        Initialize the client with your own merchant id and merchant secret.
+        See `BaseClient` for the other available options.
+
+        :param max_connections: The maximum number of simultaneous connections
+            in the connection pool.  Requests exceeding the limit wait for a
+            free connection.
+        """
+        super(AsyncClient, self).__init__(
+            merchant_id, merchant_secret, **options
+        )
+        self.max_connections = max_connections
+        self._session = None
+
+    @property
+    def session(self):
+        """The `aiohttp.ClientSession` used for API requests.  It is created
+        on first use, because aiohttp sessions must be created inside a
+        running event loop."""
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_connections),
+                auth=aiohttp.BasicAuth(self.merchant_id, self.merchant_secret),
+                headers=self.HEADERS
+            )
+        return self._session
+
+    async def create_payment(self, payment):
+        """Creates a new payment and returns a `dict` with the following data:
+        `order_number`, `token` and `url`.  Raises `VerkkomaksutException` if
+        the payment is invalid or the API rejects it.
+
+        :param payment: a `Payment` object
+
+        """
+        if self.metrics is not None:
+            return await self._create_payment_measured(payment)
+        self._check_payment(payment)
+        body = self._encode_payment(payment)
+        status, content = await self._send(body)
+        return self._handle_response(status, content)
+
+    async def _create_payment_measured(self, payment):
+        measurement = _Measurement(payment)
+        try:
+            self._check_payment(payment)
+            measurement.next_phase()
+            body = measurement.body = self._encode_payment(payment)
+            measurement.next_phase()
+            status, content = await self._send(body)
+            measurement.status_code = status
+            measurement.next_phase()
+            return self._handle_response(status, content)
+        except Exception as exc:
+            measurement.fail(exc)
+            raise
+        finally:
+            self._record_metrics(measurement)
+
+    async def _send(self, body):
+        limiter = self.rate_limiter
+        breaker = self.circuit_breaker
+        if limiter is not None:
+            permit = limiter.try_acquire()
+            while permit is None:
+                await asyncio.sleep(limiter.wait_time())
+                permit = limiter.try_acquire()
+        try:
+            self._check_circuit()
+            started = time.time()
+            failed = True
+            try:
+                async with self.session.post(
+                    self.SERVICE_URL,
+                    data=body
+                ) as response:
+                    content = await response.read()
+                failed = response.status >= 500
+            finally:
+                if breaker is not None:
+                    breaker.record(failed, time.time() - started)
+        finally:
+            if limiter is not None:
+                limiter.release(permit)
+        return response.status, content
+
+    async def close(self):
+        """Closes the pooled connections of this client."""
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""
+    verkkomaksut.asgi
+    ~~~~~~~~~~~~~~~~~
+
+    ASGI counterpart of `verkkomaksut.middleware`::
+
+        app = ReceiptMiddleware(app, client, [
+            '/payment/success', '/payment/failure', '/payment/notify'
+        ])
+
+    The application finds the validated `Receipt` in
+    ``scope['verkkomaksut.receipt']``.
+
+    This module requires Python 3.5 or newer.
+
+    :copyright: (c) 2013 by Janne Vanhala.
+    :license: BSD, see LICENSE for more details.
+"""
+from .middleware import ENVIRON_KEY, _parse_query, _REJECTED_BODY
+
+
+class ReceiptMiddleware(object):
+    """Validates the receipt in the query string of every HTTP request to
+    the given `paths`, like `verkkomaksut.middleware.ReceiptMiddleware`.
+    Requests with a valid receipt are passed to the application with the
+    `Receipt` in ``scope['verkkomaksut.receipt']``, and other requests are
+    answered with ``400 Bad Request``.
+
+    :param app: The ASGI application.
+    :param client: The `Client` or `verkkomaksut.aio.AsyncClient`
+        validating the receipts.
+    :param paths: The paths of the success, failure, pending and
+        notification URLs.
+    """
+
+    def __init__(self, app, client, paths):
+        self.app = app
+        self.client = client
+        self.paths = frozenset(paths)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or scope['path'] not in self.paths:
+            await self.app(scope, receive, send)
+            return
+        receipt = self.client.verify_receipt(
+            _parse_query(scope.get('query_string', b'').decode('latin-1'))
+        )
+        if receipt is None:
+            await send({
+                'type': 'http.response.start',
+                'status': 400,
+                'headers': [
+                    (b'content-type', b'text/plain'),
+                    (b'content-length', str(len(_REJECTED_BODY)).encode()),
+                ],
+            })
+            await send({'type': 'http.response.body', 'body': _REJECTED_BODY})
+            return
+        scope = dict(scope)
+        scope[ENVIRON_KEY] = receipt
+        await self.app(scope, receive, send)
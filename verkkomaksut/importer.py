@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""
+    verkkomaksut.importer
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    Creates payments from large order exports in CSV or JSON Lines format
+    without loading the whole export into memory::
+
+        template = PaymentTemplate(
+            success_url='https://www.esimerkkikauppa.fi/sv/success',
+            failure_url='https://www.esimerkkikauppa.fi/sv/failure',
+            notification_url='https://www.esimerkkikauppa.fi/sv/notify'
+        )
+        with open('orders.csv') as export:
+            for result in import_payments(client, read_csv(export), template):
+                if result.error is not None:
+                    log_failure(result.payment.order_number, result.error)
+
+    The export has one row per product.  Each row holds the order number,
+    the contact of the payer and, optionally, the reference number and
+    description of its order, in the columns named by `ORDER_COLUMNS` and
+    `CONTACT_COLUMNS`, and one product in the columns named by
+    `PRODUCT_COLUMNS`.  The rows of an order must be next to each other;
+    the order level columns are read from its first row.  Empty values are
+    treated as missing.
+
+    :copyright: (c) 2013 by Janne Vanhala.
+    :license: BSD, see LICENSE for more details.
+"""
+import csv
+from itertools import groupby, islice
+
+from . import ContactCache, Product, ProductTable, _json_loads
+
+#: The order level columns.  The order number is required.
+ORDER_COLUMNS = ('order_number', 'reference_number', 'description')
+
+#: The contact columns, in the order of the arguments of `Contact`.  The
+#: first seven are required.
+CONTACT_COLUMNS = ContactCache.FIELDS
+
+#: The product columns, in the order of the arguments of `Product`.  The
+#: first three are required on rows with a product.  Rows without a title
+#: have no product.  The price, VAT, amount and discount are converted to
+#: integers or floats, and the type to an integer.
+PRODUCT_COLUMNS = (
+    'title', 'price', 'vat', 'amount', 'code', 'discount', 'type'
+)
+
+_PRODUCT_DEFAULTS = (None, None, None, 1, None, 0, Product.TYPE_NORMAL)
+
+_TEXT_TYPES = (type(u''), type(''))
+
+
+def read_csv(export, encoding='utf-8', **fmtparams):
+    """Yields the rows of a CSV export with a header row as dictionaries.
+
+    :param export: The CSV file.  On Python 3 it must be opened in text
+        mode with ``newline=''``, and on Python 2 in binary mode.
+    :param encoding: The encoding of the file on Python 2.
+    :param fmtparams: Passed to `csv.DictReader`.
+    """
+    for row in csv.DictReader(export, **fmtparams):
+        if bytes is str:  # Python 2
+            row = dict(
+                (key.decode(encoding), value.decode(encoding))
+                for key, value in row.items()
+                if isinstance(key, bytes) and isinstance(value, bytes)
+            )
+        yield row
+
+
+def read_json_lines(export):
+    """Yields the rows of a JSON Lines export, one JSON object on each
+    line, as dictionaries.  Blank lines are skipped.
+
+    :param export: The JSON Lines file.
+    """
+    for line in export:
+        if line.strip():
+            yield _json_loads(line)
+
+
+def build_payments(rows, template, contacts=None):
+    """Groups the rows of an export by order number and yields a payment
+    for each order, created with `template`.  The rows are consumed lazily,
+    so only the rows of one order are held in memory at a time.  The
+    products of each payment are stored in a `ProductTable`.
+
+    :param rows: An iterable of row dictionaries, such as `read_csv` or
+        `read_json_lines`.
+    :param template: The `PaymentTemplate` giving the URLs and the other
+        options of the payments.
+    :param contacts: A `ContactCache` for sharing the contacts of repeat
+        customers.  Defaults to a new cache for this import.
+    :raises ValueError: if a row is missing a required column or has an
+        invalid numeric column.
+    """
+    if contacts is None:
+        contacts = ContactCache()
+    for order_number, order_rows in groupby(rows, _order_number):
+        first = next(order_rows)
+        contact = contacts.get(*_columns(first, CONTACT_COLUMNS, 7))
+        table = ProductTable()
+        for row in _chain_first(first, order_rows):
+            if _value(row, 'title') is not None:
+                table.append(*_product(row))
+        yield template.payment(
+            order_number, contact, table,
+            reference_number=_value(first, 'reference_number'),
+            description=_value(first, 'description')
+        )
+
+
+def import_payments(client, rows, template, contacts=None, chunk_size=100,
+                    max_concurrency=10):
+    """Creates a payment for each order in the rows of an export and yields
+    a `PaymentResult` for each of them, in the order of the export.  The
+    payments are built with `build_payments` and created in chunks of
+    `chunk_size` with `Client.create_payments`, so the memory used stays
+    the same however large the export is.
+
+    :param client: The `Client` creating the payments.
+    :param rows: An iterable of row dictionaries.
+    :param template: The `PaymentTemplate` of the payments.
+    :param contacts: A `ContactCache` for the contacts.
+    :param chunk_size: The number of payments built at a time.
+    :param max_concurrency: The maximum number of simultaneous requests to
+        the API.
+    """
+    payments = build_payments(rows, template, contacts)
+    while True:
+        chunk = list(islice(payments, chunk_size))
+        if not chunk:
+            return
+        for result in client.create_payments(chunk, max_concurrency):
+            yield result
+
+
+def _value(row, column):
+    value = row.get(column)
+    if value == '':
+        return None
+    return value
+
+
+def _order_number(row):
+    order_number = _value(row, 'order_number')
+    if order_number is None:
+        raise ValueError('A row is missing its order number.')
+    return order_number
+
+
+def _columns(row, columns, required):
+    values = [_value(row, column) for column in columns]
+    for column, value in zip(columns[:required], values):
+        if value is None:
+            raise ValueError(
+                'Order %r is missing the %s column.'
+                % (row['order_number'], column)
+            )
+    return values
+
+
+def _number(value):
+    if not isinstance(value, _TEXT_TYPES):
+        return value
+    try:
+        return int(value)
+    except ValueError:
+        return float(value)
+
+
+_CONVERTERS = {
+    'price': _number,
+    'vat': _number,
+    'amount': _number,
+    'discount': _number,
+    'type': int,
+}
+
+
+def _product(row):
+    values = _columns(row, PRODUCT_COLUMNS, 3)
+    product = []
+    for column, value, default in zip(PRODUCT_COLUMNS, values,
+                                      _PRODUCT_DEFAULTS):
+        if value is None:
+            value = default
+        elif column in _CONVERTERS:
+            try:
+                value = _CONVERTERS[column](value)
+            except (TypeError, ValueError):
+                raise ValueError(
+                    'Order %r has an invalid %s column.'
+                    % (row['order_number'], column)
+                )
+        product.append(value)
+    return product
+
+
+def _chain_first(first, rest):
+    yield first
+    for row in rest:
+        yield row
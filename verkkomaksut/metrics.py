@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""
+    verkkomaksut.metrics
+    ~~~~~~~~~~~~~~~~~~~~
+
+    Instrumentation of the API calls made by `Client`.  Pass a metrics sink,
+    any object with a ``record(metrics)`` method, as the `metrics` option of
+    the client, and it receives a `RequestMetrics` for every payment created::
+
+        recorder = HistogramRecorder()
+        client = Client(merchant_id, merchant_secret, metrics=recorder)
+        ...
+        print(recorder.prometheus())
+
+    :copyright: (c) 2013 by Janne Vanhala.
+    :license: BSD, see LICENSE for more details.
+"""
+import threading
+from collections import namedtuple
+
+#: The measurements of a single `create_payment` call.  The phases are
+#: given in seconds: `build` is the time spent validating the payment,
+#: `encode` building and encoding the request body, `network` sending the
+#: request and receiving the response, and `decode` decoding the response.
+#: `status_code` is `None` if no response was received, and `error_code` is
+#: the code of the `VerkkomaksutException` raised, the class name of any
+#: other exception raised, or `None` on success.
+RequestMetrics = namedtuple('RequestMetrics', [
+    'order_number', 'build', 'encode', 'network', 'decode', 'payload_size',
+    'product_count', 'status_code', 'error_code'
+])
+
+#: Upper bounds of the default buckets for durations, in seconds.
+DURATION_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+    0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+)
+
+#: Upper bounds of the default buckets for payload sizes, in bytes.
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+#: Upper bounds of the default buckets for product counts.
+COUNT_BUCKETS = (1, 5, 10, 50, 100, 500)
+
+
+class Histogram(object):
+    """Counts observed values in buckets with the given upper bounds.  Values
+    over the largest bound are counted in an implicit last bucket."""
+
+    def __init__(self, buckets):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        """Adds a value to the histogram."""
+        index = 0
+        for bound in self.buckets:
+            if value <= bound:
+                break
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """Returns an upper bound of the `q` quantile, between 0 and 1, of
+        the observed values: the bound of the bucket containing it.  Returns
+        `None` if there are no values or the quantile is over the largest
+        bound."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            if total >= rank:
+                return bound
+        return None
+
+    def snapshot(self):
+        """Returns the histogram as a `dict` with the `count` and `sum` of
+        the values and the cumulative `buckets` as ``(bound, count)`` pairs,
+        the last bound being ``float('inf')``."""
+        buckets = []
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            buckets.append((bound, total))
+        return {'count': self.count, 'sum': self.sum, 'buckets': buckets}
+
+
+class HistogramRecorder(object):
+    """A metrics sink that keeps histograms of the phase timings, payload
+    sizes and product counts of all calls, and counts the calls by status
+    code and error code.  One recorder can be shared by many clients and
+    threads.
+
+    :param duration_buckets: Bucket bounds of the phase timings, in seconds.
+    """
+
+    PHASES = ('build', 'encode', 'network', 'decode')
+
+    def __init__(self, duration_buckets=DURATION_BUCKETS):
+        self.duration_buckets = duration_buckets
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Forgets all recorded calls."""
+        with self._lock:
+            self._phases = dict(
+                (phase, Histogram(self.duration_buckets))
+                for phase in self.PHASES + ('total',)
+            )
+            self._payload_size = Histogram(SIZE_BUCKETS)
+            self._product_count = Histogram(COUNT_BUCKETS)
+            self._status_codes = {}
+            self._error_codes = {}
+
+    def record(self, metrics):
+        """Records the `RequestMetrics` of one call."""
+        with self._lock:
+            total = 0
+            for phase in self.PHASES:
+                value = getattr(metrics, phase)
+                self._phases[phase].observe(value)
+                total += value
+            self._phases['total'].observe(total)
+            self._payload_size.observe(metrics.payload_size)
+            self._product_count.observe(metrics.product_count)
+            _increment(self._status_codes, metrics.status_code)
+            if metrics.error_code is not None:
+                _increment(self._error_codes, metrics.error_code)
+
+    def snapshot(self):
+        """Returns the recorded metrics as a `dict` with the histogram
+        snapshots of each phase, ``total``, ``payload_size`` and
+        ``product_count``, and the call counts by ``status_codes`` and
+        ``error_codes``."""
+        with self._lock:
+            data = dict(
+                (name, histogram.snapshot())
+                for name, histogram in self._phases.items()
+            )
+            data['payload_size'] = self._payload_size.snapshot()
+            data['product_count'] = self._product_count.snapshot()
+            data['status_codes'] = dict(self._status_codes)
+            data['error_codes'] = dict(self._error_codes)
+        return data
+
+    def prometheus(self, prefix='verkkomaksut'):
+        """Returns the recorded metrics in the Prometheus text exposition
+        format, for serving from a metrics endpoint."""
+        data = self.snapshot()
+        lines = []
+        histograms = [
+            ('%s_request_%s_seconds' % (prefix, name), data[name])
+            for name in self.PHASES + ('total',)
+        ]
+        histograms += [
+            ('%s_request_payload_bytes' % prefix, data['payload_size']),
+            ('%s_request_products' % prefix, data['product_count']),
+        ]
+        for name, histogram in histograms:
+            lines.append('# TYPE %s histogram' % name)
+            for bound, count in histogram['buckets']:
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append('%s_bucket{le="%s"} %d' % (name, le, count))
+            lines.append('%s_sum %r' % (name, histogram['sum']))
+            lines.append('%s_count %d' % (name, histogram['count']))
+        for name, label, counts in (
+            ('%s_requests_total' % prefix, 'status', data['status_codes']),
+            ('%s_errors_total' % prefix, 'code', data['error_codes']),
+        ):
+            lines.append('# TYPE %s counter' % name)
+            for value in sorted(counts, key=str):
+                lines.append('%s{%s="%s"} %d' % (
+                    name, label, 'none' if value is None else value,
+                    counts[value]
+                ))
+        return '\n'.join(lines) + '\n'
+
+
+def _increment(counts, key):
+    counts[key] = counts.get(key, 0) + 1
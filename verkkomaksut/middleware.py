@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+    verkkomaksut.middleware
+    ~~~~~~~~~~~~~~~~~~~~~~~
+
+    WSGI middleware validating the receipts Suomen Verkkomaksut sends to the
+    success, failure, pending and notification URLs before the requests
+    reach the application::
+
+        app.wsgi_app = ReceiptMiddleware(app.wsgi_app, client, [
+            '/payment/success', '/payment/failure', '/payment/notify'
+        ])
+
+    The application finds the validated `Receipt` in
+    ``environ['verkkomaksut.receipt']``.  For ASGI applications, see
+    `verkkomaksut.asgi`.
+
+    :copyright: (c) 2013 by Janne Vanhala.
+    :license: BSD, see LICENSE for more details.
+"""
+try:
+    from urllib.parse import parse_qs
+except ImportError:  # Python 2
+    from urlparse import parse_qs
+
+#: The key of the validated `Receipt` in the WSGI environ and ASGI scope.
+ENVIRON_KEY = 'verkkomaksut.receipt'
+
+_RECEIPT_PARAMS = (
+    'RETURN_AUTHCODE', 'ORDER_NUMBER', 'TIMESTAMP', 'PAID', 'METHOD'
+)
+
+_REJECTED_STATUS = '400 Bad Request'
+_REJECTED_BODY = b'Invalid payment receipt'
+
+
+def _parse_query(query_string):
+    """Returns the receipt parameters in the given query string as a `dict`
+    of their first values."""
+    query = parse_qs(query_string)
+    return dict(
+        (name, query[name][0]) for name in _RECEIPT_PARAMS if name in query
+    )
+
+
+class ReceiptMiddleware(object):
+    """Validates the receipt in the query string of every request to the
+    given `paths` with `Client.verify_receipt`.  Requests with a valid
+    receipt are passed to the application with the `Receipt` in
+    ``environ['verkkomaksut.receipt']``.  Requests with a missing, forged or,
+    with the `replay_cache` and `max_receipt_age` options of the client,
+    replayed or stale receipt are answered with ``400 Bad Request`` without
+    calling the application.
+
+    :param app: The WSGI application.
+    :param client: The `Client` validating the receipts.
+    :param paths: The paths of the success, failure, pending and
+        notification URLs.
+    """
+
+    def __init__(self, app, client, paths):
+        self.app = app
+        self.client = client
+        self.paths = frozenset(paths)
+
+    def __call__(self, environ, start_response):
+        if environ.get('PATH_INFO') not in self.paths:
+            return self.app(environ, start_response)
+        receipt = self.client.verify_receipt(
+            _parse_query(environ.get('QUERY_STRING', ''))
+        )
+        if receipt is None:
+            start_response(_REJECTED_STATUS, [
+                ('Content-Type', 'text/plain'),
+                ('Content-Length', str(len(_REJECTED_BODY)))
+            ])
+            return [_REJECTED_BODY]
+        environ[ENVIRON_KEY] = receipt
+        return self.app(environ, start_response)
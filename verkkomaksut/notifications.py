@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""
+    verkkomaksut.notifications
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    A pipeline for processing the notification URL requests of Suomen
+    Verkkomaksut away from the web workers.  The workers only enqueue the
+    query parameters, and a consumer receives validated `Receipt` objects
+    in batches::
+
+        pipeline = NotificationPipeline(client, max_queue=10000)
+
+        # In the view of the notification URL:
+        pipeline.put(request.args)
+
+        # In a consumer thread:
+        for receipt in pipeline:
+            mark_order_paid(receipt.order_number)
+
+    :copyright: (c) 2013 by Janne Vanhala.
+    :license: BSD, see LICENSE for more details.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    from queue import Empty, Queue
+except ImportError:  # Python 2
+    from Queue import Empty, Queue
+
+from . import _parse_receipt
+
+_closed = object()
+
+
+class NotificationPipeline(object):
+    """Validates receipt parameters in micro-batches and yields a `Receipt`
+    for each valid one that has not been seen before.
+
+    The parameters are held in a queue of at most `max_queue` items.  When
+    the queue is full, `put` blocks until the consumer catches up, or
+    raises `queue.Full` if it is given a timeout.  Receipts are yielded in
+    the order they were put.  Invalid receipts are dropped and counted in
+    `rejected`, and repeated notifications for the same order and payment
+    code are dropped and counted in `duplicates`.
+
+    :param client: The `Client` whose merchant secret, `replay_cache` and
+        `max_receipt_age` are used for validating the receipts.
+    :param max_queue: The maximum number of receipts waiting to be
+        validated.
+    :param batch_size: The maximum number of receipts validated at a time.
+    :param batch_timeout: The maximum number of seconds to wait for a batch
+        to fill up after its first receipt.
+    :param dedupe_size: The number of recent orders remembered for dropping
+        duplicate notifications.
+    """
+
+    def __init__(self, client, max_queue=1000, batch_size=100,
+                 batch_timeout=0.05, dedupe_size=10000):
+        self.client = client
+        self.batch_size = batch_size
+        self.batch_timeout = batch_timeout
+        self.dedupe_size = dedupe_size
+
+        #: The number of receipts yielded.
+        self.accepted = 0
+
+        #: The number of invalid receipts dropped.
+        self.rejected = 0
+
+        #: The number of duplicate receipts dropped.
+        self.duplicates = 0
+
+        self._queue = Queue(max_queue)
+        self._seen = OrderedDict()
+        self._lock = threading.Lock()
+
+    def put(self, params, block=True, timeout=None):
+        """Enqueues the query parameters of one notification, given as a
+        mapping such as ``request.args``.  Waits while the queue is full,
+        at most `timeout` seconds if given."""
+        self._queue.put(params, block, timeout)
+
+    def qsize(self):
+        """Returns the approximate number of notifications waiting."""
+        return self._queue.qsize()
+
+    def close(self):
+        """Signals that no more notifications will be put.  The consumer
+        stops after the notifications already queued."""
+        self._queue.put(_closed)
+
+    def __iter__(self):
+        return self.receipts()
+
+    def receipts(self):
+        """Yields the validated receipts until `close` is called."""
+        while True:
+            batch, closed = self._next_batch()
+            for receipt in self.process(batch):
+                yield receipt
+            if closed:
+                return
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        if batch[0] is _closed:
+            return [], True
+        deadline = time.time() + self.batch_timeout
+        while len(batch) < self.batch_size:
+            try:
+                params = self._queue.get(
+                    timeout=max(0, deadline - time.time())
+                )
+            except Empty:
+                break
+            if params is _closed:
+                return batch, True
+            batch.append(params)
+        return batch, False
+
+    def process(self, batch):
+        """Validates a list of query parameter mappings at once and returns
+        a list of the new valid receipts among them."""
+        parsed = [_parse_receipt(params) for params in batch]
+        valid = bytearray(len(parsed))
+        validator = self.client.receipt_validator
+        for failed in (False, True):
+            indexes = [
+                index for index, (authcode, receipt) in enumerate(parsed)
+                if receipt is not None and receipt.failed == failed
+            ]
+            if not indexes:
+                continue
+            results = validator.validate_many(
+                [parsed[index][0] for index in indexes],
+                *zip(*[parsed[index][1].params for index in indexes])
+            )
+            for index, result in zip(indexes, results):
+                valid[index] = result
+
+        receipts = []
+        with self._lock:
+            for (authcode, receipt), result in zip(parsed, valid):
+                if not result:
+                    self.rejected += 1
+                elif self._is_duplicate(receipt):
+                    self.duplicates += 1
+                elif not self.client._admit_receipt(*receipt.params):
+                    self.rejected += 1
+                else:
+                    self.accepted += 1
+                    receipts.append(receipt)
+        return receipts
+
+    def _is_duplicate(self, receipt):
+        key = (receipt.order_number, receipt.paid)
+        if key in self._seen:
+            return True
+        self._seen[key] = True
+        while len(self._seen) > self.dedupe_size:
+            self._seen.popitem(last=False)
+        return False
@@ -0,0 +1,339 @@
+# -*- coding: utf-8 -*-
+"""
+    verkkomaksut.policies
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    Policies controlling how `Client` talks to the Suomen Verkkomaksut API
+    when it is busy, slow or failing.
+
+    :copyright: (c) 2013 by Janne Vanhala.
+    :license: BSD, see LICENSE for more details.
+"""
+import threading
+import time
+from collections import deque
+
+
+class RetryPolicy(object):
+    """Retries failed payment creation requests with exponential backoff.
+
+    Only connection errors and ``5xx`` responses are retried; other errors
+    are never retried, because the API has already rejected the payment.
+    The request body is encoded once and sent unchanged on every attempt, so
+    the order number identifies all attempts as the same payment.
+
+    :param max_attempts: The maximum number of attempts, including the first
+        one.
+    :param backoff: The delay in seconds before the second attempt.  The
+        delay doubles on each further attempt.
+    :param max_backoff: The upper limit of a single delay in seconds.
+    :param jitter: If `True`, each delay is picked at random between zero and
+        the computed delay, so that many clients failing at the same time do
+        not retry in lockstep.
+    :param deadline: If given, the maximum number of seconds all attempts
+        together may take.  The timeout of each attempt is shortened so that
+        the deadline is not exceeded.
+    """
+
+    def __init__(self, max_attempts=3, backoff=0.1, max_backoff=5.0,
+                 jitter=True, deadline=None):
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.deadline = deadline
+
+    def delay(self, attempt):
+        """Returns the number of seconds to wait after the given failed
+        attempt, counting from 1."""
+        delay = min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+        if self.jitter:
+            import random
+            delay = random.uniform(0, delay)
+        return delay
+
+    def is_retryable_status(self, status_code):
+        """Returns `True` if a response with the given status code should be
+        retried."""
+        return 500 <= status_code < 600
+
+    def start(self):
+        """Returns the time by which all attempts must finish, or `None` if
+        there is no deadline."""
+        if self.deadline is None:
+            return None
+        return time.time() + self.deadline
+
+    def next_delay(self, attempt, deadline):
+        """Returns the number of seconds to wait before retrying after the
+        given failed attempt, or `None` if no more attempts may be made."""
+        if attempt >= self.max_attempts:
+            return None
+        delay = self.delay(attempt)
+        if deadline is not None and time.time() + delay >= deadline:
+            return None
+        return delay
+
+
+class RateLimiter(object):
+    """Limits the rate and concurrency of requests to the API, so that a
+    burst of payments is queued on the client instead of being throttled by
+    the API.
+
+    The rate is limited with a token bucket: a request consumes one token,
+    and tokens are refilled at `rate` per second up to `burst` tokens.  The
+    concurrency is limited by allowing at most `max_in_flight` requests at a
+    time.  One limiter can be shared by any number of threads and clients,
+    including `verkkomaksut.aio.AsyncClient`.
+
+    Use `FileRateLimiter` to share the limits between processes.
+
+    :param rate: The maximum sustained number of requests per second, or
+        `None` for no rate limit.
+    :param burst: The maximum number of requests that can be made at once
+        after a quiet period.  Defaults to `rate`, but at least 1.
+    :param max_in_flight: The maximum number of simultaneous requests, or
+        `None` for no limit.
+    """
+
+    #: How long to wait before checking again for a free request slot.
+    POLL_INTERVAL = 0.005
+
+    def __init__(self, rate=None, burst=None, max_in_flight=None):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1, rate or 0)
+        self.max_in_flight = max_in_flight
+        self._tokens = float(self.burst)
+        self._updated = time.time()
+        self._in_flight = 0
+        self._lock = threading.Lock()
+
+    def _refill(self, tokens, updated, now):
+        return min(self.burst, tokens + (now - updated) * self.rate)
+
+    def try_acquire(self):
+        """Acquires permission for one request without waiting.  Returns a
+        permit that must be passed to `release` when the request is done, or
+        `None` if the request must wait."""
+        with self._lock:
+            if (self.max_in_flight is not None and
+                    self._in_flight >= self.max_in_flight):
+                return None
+            if self.rate is not None:
+                now = time.time()
+                tokens = self._refill(self._tokens, self._updated, now)
+                self._updated = now
+                if tokens < 1:
+                    self._tokens = tokens
+                    return None
+                self._tokens = tokens - 1
+            self._in_flight += 1
+            return True
+
+    def wait_time(self):
+        """Returns an estimate of the number of seconds until `try_acquire`
+        may succeed."""
+        with self._lock:
+            if (self.max_in_flight is not None and
+                    self._in_flight >= self.max_in_flight):
+                return self.POLL_INTERVAL
+            if self.rate is None:
+                return 0
+            tokens = self._refill(self._tokens, self._updated, time.time())
+            return max(0, (1 - tokens) / self.rate)
+
+    def acquire(self):
+        """Waits until a request is permitted and returns a permit that must
+        be passed to `release` when the request is done."""
+        while True:
+            permit = self.try_acquire()
+            if permit is not None:
+                return permit
+            time.sleep(max(self.wait_time(), self.POLL_INTERVAL))
+
+    def release(self, permit):
+        """Marks the request of the given permit as done."""
+        with self._lock:
+            self._in_flight -= 1
+
+
+class FileRateLimiter(RateLimiter):
+    """A `RateLimiter` whose limits are shared by all processes on a host
+    that use the same `path`, for example the workers of a gunicorn server.
+
+    The token bucket is stored in the file at `path`, and each request slot
+    is a lock file next to it.  The files are locked with ``flock``, so a
+    slot is freed automatically if its process dies.  Available on Unix
+    only.
+    """
+
+    def __init__(self, path, rate=None, burst=None, max_in_flight=None):
+        super(FileRateLimiter, self).__init__(rate, burst, max_in_flight)
+        self.path = path
+
+    def try_acquire(self):
+        slot = None
+        if self.max_in_flight is not None:
+            slot = self._lock_slot()
+            if slot is None:
+                return None
+        if self.rate is not None and not self._take_token():
+            if slot is not None:
+                slot.close()
+            return None
+        return slot if slot is not None else True
+
+    def wait_time(self):
+        if self.rate is None:
+            return self.POLL_INTERVAL
+        with self._open_bucket() as bucket:
+            tokens, updated = self._read_bucket(bucket)
+        wait = (1 - self._refill(tokens, updated, time.time())) / self.rate
+        return max(wait, self.POLL_INTERVAL)
+
+    def release(self, permit):
+        if permit is not True:
+            permit.close()
+
+    def _lock_slot(self):
+        import fcntl
+        for index in range(self.max_in_flight):
+            slot = open('%s.slot%d' % (self.path, index), 'a')
+            try:
+                fcntl.flock(slot, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError):
+                slot.close()
+                continue
+            return slot
+        return None
+
+    def _open_bucket(self):
+        return open(self.path, 'a+')
+
+    def _read_bucket(self, bucket):
+        bucket.seek(0)
+        try:
+            tokens, updated = bucket.read().split()
+            return float(tokens), float(updated)
+        except ValueError:
+            return float(self.burst), time.time()
+
+    def _take_token(self):
+        import fcntl
+        with self._open_bucket() as bucket:
+            fcntl.flock(bucket, fcntl.LOCK_EX)
+            tokens, updated = self._read_bucket(bucket)
+            now = time.time()
+            tokens = self._refill(tokens, updated, now)
+            acquired = tokens >= 1
+            if acquired:
+                tokens -= 1
+            bucket.seek(0)
+            bucket.truncate()
+            bucket.write('%r %r' % (tokens, now))
+            bucket.flush()
+        return acquired
+
+
+class CircuitBreaker(object):
+    """Stops sending requests to the API while it is failing, so that callers
+    fail fast instead of waiting for timeouts.
+
+    The breaker records the outcome of the last `window` requests.  A
+    request fails if it raises an error, gets a ``5xx`` response or takes
+    longer than `slow_call_duration`.  When at least `min_calls` requests
+    have been recorded and the share of failures reaches
+    `failure_threshold`, the circuit opens and requests are refused for
+    `reset_timeout` seconds.  After that the circuit is half-open: up to
+    `half_open_calls` trial requests are let through.  If they all succeed
+    the circuit closes again; if any of them fails it opens again.
+
+    :param failure_threshold: The share of failed requests, between 0 and 1,
+        that opens the circuit.
+    :param window: The number of recent requests considered.
+    :param min_calls: The minimum number of recorded requests before the
+        circuit can open.
+    :param slow_call_duration: If given, requests taking longer than this
+        many seconds count as failures.
+    :param reset_timeout: The number of seconds the circuit stays open.
+    :param half_open_calls: The number of trial requests made while the
+        circuit is half-open.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold=0.5, window=20, min_calls=10,
+                 slow_call_duration=None, reset_timeout=30.0,
+                 half_open_calls=1):
+        self.failure_threshold = failure_threshold
+        self.min_calls = min_calls
+        self.slow_call_duration = slow_call_duration
+        self.reset_timeout = reset_timeout
+        self.half_open_calls = half_open_calls
+        self._outcomes = deque(maxlen=window)
+        self._state = self.CLOSED
+        self._opened_at = None
+        self._trials = 0
+        self._successful_trials = 0
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        """The current state: `CLOSED`, `OPEN` or `HALF_OPEN`."""
+        with self._lock:
+            self._update_state()
+            return self._state
+
+    def _update_state(self):
+        if (self._state == self.OPEN and
+                time.time() - self._opened_at >= self.reset_timeout):
+            self._state = self.HALF_OPEN
+            self._trials = 0
+            self._successful_trials = 0
+
+    def _open(self):
+        self._state = self.OPEN
+        self._opened_at = time.time()
+        self._outcomes.clear()
+
+    def allow(self):
+        """Returns `True` if a request may be made now.  Every allowed
+        request must be followed by a call to `record`."""
+        with self._lock:
+            self._update_state()
+            if self._state == self.CLOSED:
+                return True
+            if (self._state == self.HALF_OPEN and
+                    self._trials < self.half_open_calls):
+                self._trials += 1
+                return True
+            return False
+
+    def record(self, failed, duration):
+        """Records the outcome of an allowed request.
+
+        :param failed: `True` if the request raised an error or got a server
+            error response.
+        :param duration: The duration of the request in seconds.
+        """
+        if (self.slow_call_duration is not None and
+                duration > self.slow_call_duration):
+            failed = True
+        with self._lock:
+            if self._state == self.HALF_OPEN:
+                if failed:
+                    self._open()
+                else:
+                    self._successful_trials += 1
+                    if self._successful_trials >= self.half_open_calls:
+                        self._state = self.CLOSED
+                return
+            if self._state == self.OPEN:
+                return
+            self._outcomes.append(failed)
+            calls = len(self._outcomes)
+            if (calls >= self.min_calls and
+                    sum(self._outcomes) >= self.failure_threshold * calls):
+                self._open()
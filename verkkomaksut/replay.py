@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""
+    verkkomaksut.replay
+    ~~~~~~~~~~~~~~~~~~~
+
+    Caches of the receipts already accepted, for rejecting replayed
+    receipts.  Pass one as the `replay_cache` option of `Client`::
+
+        client = Client(
+            merchant_id, merchant_secret,
+            replay_cache=SQLiteReplayCache('/var/run/shop/receipts.db'),
+            max_receipt_age=3600
+        )
+
+    :copyright: (c) 2013 by Janne Vanhala.
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class MemoryReplayCache(object):
+    """Remembers receipts in memory for `ttl` seconds.  At most `max_size`
+    receipts are remembered; when the cache is full the oldest ones are
+    forgotten first, even if they have not expired yet.
+
+    The cache is shared by the threads of one process only.  Use
+    `SQLiteReplayCache` to share it between processes.
+
+    :param max_size: The maximum number of receipts remembered.
+    :param ttl: The number of seconds a receipt is remembered.  This should
+        be at least the `max_receipt_age` of the client.
+    """
+
+    def __init__(self, max_size=100000, ttl=86400):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._expires = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, key):
+        """Remembers the receipt identified by the tuple `key`.  Returns
+        `True` if it was not seen before, and `False` if it is a replay."""
+        now = time.time()
+        with self._lock:
+            expires = self._expires
+            while expires:
+                oldest = next(iter(expires))
+                if expires[oldest] > now:
+                    break
+                del expires[oldest]
+            if key in expires:
+                return False
+            expires[key] = now + self.ttl
+            while len(expires) > self.max_size:
+                expires.popitem(last=False)
+            return True
+
+    def __len__(self):
+        return len(self._expires)
+
+
+class SQLiteReplayCache(object):
+    """Remembers receipts for `ttl` seconds in an SQLite database at `path`,
+    shared by all threads and processes using the same file, for example
+    the workers of a gunicorn server on one host.
+
+    :param path: The path of the database file.  It is created if it does
+        not exist.
+    :param ttl: The number of seconds a receipt is remembered.  This should
+        be at least the `max_receipt_age` of the client.
+    :param timeout: The number of seconds to wait for other processes to
+        release the database.
+    """
+
+    #: Expired receipts are deleted after this many added receipts.
+    PURGE_INTERVAL = 1000
+
+    def __init__(self, path, ttl=86400, timeout=30.0):
+        self.path = path
+        self.ttl = ttl
+        self.timeout = timeout
+        self._connection = None
+        self._pid = None
+        self._added = 0
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._connection is None or self._pid != os.getpid():
+            connection = sqlite3.connect(
+                self.path,
+                timeout=self.timeout,
+                isolation_level=None,
+                check_same_thread=False
+            )
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS receipts '
+                '(key TEXT PRIMARY KEY, expires REAL NOT NULL)'
+            )
+            self._connection = connection
+            self._pid = os.getpid()
+        return self._connection
+
+    def add(self, key):
+        """Remembers the receipt identified by the tuple `key`.  Returns
+        `True` if it was not seen before, and `False` if it is a replay."""
+        key = '|'.join(key)
+        now = time.time()
+        with self._lock:
+            connection = self._connect()
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                self._added += 1
+                if self._added % self.PURGE_INTERVAL == 0:
+                    connection.execute(
+                        'DELETE FROM receipts WHERE expires <= ?', (now,)
+                    )
+                else:
+                    connection.execute(
+                        'DELETE FROM receipts WHERE key = ? AND expires <= ?',
+                        (key, now)
+                    )
+                cursor = connection.execute(
+                    'INSERT OR IGNORE INTO receipts VALUES (?, ?)',
+                    (key, now + self.ttl)
+                )
+                added = cursor.rowcount == 1
+            except Exception:
+                connection.execute('ROLLBACK')
+                raise
+            connection.execute('COMMIT')
+            return added
+
+    def close(self):
+        """Closes the database connection of this process."""
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
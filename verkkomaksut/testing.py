@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+"""
+    verkkomaksut.testing
+    ~~~~~~~~~~~~~~~~~~~~
+
+    A local stand-in for the Suomen Verkkomaksut payment API, for tests and
+    load tests that must not touch the real service::
+
+        with StubServer(latency=0.05, error_rate=0.01) as server:
+            client = Client()
+            client.SERVICE_URL = server.service_url
+            client.create_payment(payment)
+            params = server.success_callback(payment.order_number)
+            assert client.validate_successful_payment(
+                params['RETURN_AUTHCODE'], params['ORDER_NUMBER'],
+                params['TIMESTAMP'], params['PAID'], params['METHOD']
+            )
+
+    The server can also be run from the command line with
+    ``python -m verkkomaksut.testing --port 8000``.
+
+    :copyright: (c) 2013 by Janne Vanhala.
+    :license: BSD, see LICENSE for more details.
+"""
+import base64
+import json
+import random
+import threading
+import time
+import uuid
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:  # Python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+from . import ReceiptValidator
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    wbufsize = -1
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        status, data = self.server.stub._create_payment(
+            self.path, self.headers.get('Authorization'), body
+        )
+        self._send_json(status, data)
+
+    def _send_json(self, status, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class _HTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class StubServer(object):
+    """An HTTP server implementing the ``api-payment/create`` endpoint of
+    Suomen Verkkomaksut.
+
+    Requests are authenticated with the merchant credentials, and payments
+    without an order number are rejected with the ``invalid-order-number``
+    error like the real API.  Valid payments are answered with
+    ``201 Created`` and an `orderNumber`, `token` and `url`.
+
+    :param merchant_id: The merchant id clients must authenticate with.
+        Default is the test merchant account.
+    :param merchant_secret: The merchant secret clients must authenticate
+        with, also used for signing callbacks.
+    :param host: The interface to listen on.
+    :param port: The port to listen on.  By default a free port is picked.
+    :param latency: Seconds to wait before answering each request, or a
+        callable returning the number of seconds, for example
+        ``lambda: random.expovariate(20)`` for a long-tailed distribution.
+    :param error_rate: The share of requests, between 0 and 1, answered with
+        ``500 Internal Server Error``.
+    :param max_requests_per_second: If given, requests exceeding this rate
+        are answered with ``429 Too Many Requests``.
+    :param seed: Seed for the random number generator deciding which
+        requests fail, for reproducible runs.
+    """
+
+    def __init__(self, merchant_id='13466',
+                       merchant_secret='6pKF4jkv97zmqBJ3ZL8gUw5DfT2NMQ',
+                       host='127.0.0.1', port=0, latency=0, error_rate=0,
+                       max_requests_per_second=None, seed=None):
+        self.merchant_id = merchant_id
+        self.merchant_secret = merchant_secret
+        self.latency = latency
+        self.error_rate = error_rate
+        self.max_requests_per_second = max_requests_per_second
+        self.receipt_validator = ReceiptValidator(merchant_secret)
+
+        #: The created payments, keyed by order number.
+        self.payments = {}
+
+        #: The number of requests received, including rejected ones.
+        self.request_count = 0
+
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._window = (0, 0)
+        self._server = _HTTPServer((host, port), _Handler)
+        self._server.stub = self
+        self._thread = None
+
+    @property
+    def url(self):
+        """The base URL of the server."""
+        host, port = self._server.server_address[:2]
+        return 'http://%s:%d' % (host, port)
+
+    @property
+    def service_url(self):
+        """The URL to use as `Client.SERVICE_URL`."""
+        return self.url + '/api-payment/create'
+
+    def start(self):
+        """Starts serving requests in a background thread."""
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, args=(0.05,)
+        )
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stops the server and closes its socket."""
+        if self._thread is not None:
+            self._server.shutdown()
+            self._thread.join()
+            self._thread = None
+        self._server.server_close()
+
+    def serve_forever(self):
+        """Serves requests in the current thread until interrupted."""
+        self._server.serve_forever()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def success_callback(self, order_number, paid=None, method='1',
+                         timestamp=None):
+        """Returns the query parameters Suomen Verkkomaksut sends to the
+        success and notification URLs of a payment, signed with the merchant
+        secret.
+
+        :param order_number: The order number of the payment.
+        :param paid: The payment code.  By default a random one is generated.
+        :param method: The payment method.
+        :param timestamp: The Unix timestamp of the payment.  Defaults to the
+            current time.
+        """
+        if paid is None:
+            paid = uuid.uuid4().hex[:10].upper()
+        params = {
+            'ORDER_NUMBER': order_number,
+            'TIMESTAMP': self._timestamp(timestamp),
+            'PAID': paid,
+            'METHOD': method,
+        }
+        params['RETURN_AUTHCODE'] = self.receipt_validator.calculate_hash(
+            params['ORDER_NUMBER'], params['TIMESTAMP'], params['PAID'],
+            params['METHOD']
+        )
+        return params
+
+    def failure_callback(self, order_number, timestamp=None):
+        """Returns the query parameters Suomen Verkkomaksut sends to the
+        failure URL of a cancelled payment, signed with the merchant secret.
+        """
+        params = {
+            'ORDER_NUMBER': order_number,
+            'TIMESTAMP': self._timestamp(timestamp),
+        }
+        params['RETURN_AUTHCODE'] = self.receipt_validator.calculate_hash(
+            params['ORDER_NUMBER'], params['TIMESTAMP']
+        )
+        return params
+
+    def _timestamp(self, timestamp):
+        return str(int(time.time() if timestamp is None else timestamp))
+
+    def _create_payment(self, path, authorization, body):
+        with self._lock:
+            self.request_count += 1
+            throttled = self._throttled()
+            failed = self._random.random() < self.error_rate
+
+        latency = self.latency() if callable(self.latency) else self.latency
+        if latency:
+            time.sleep(latency)
+
+        if path.split('?')[0] != '/api-payment/create':
+            return 404, _error('not-found', 'Not found')
+        if authorization != self._authorization():
+            return 401, _error(
+                'invalid-credentials', 'Invalid merchant id or secret'
+            )
+        if throttled:
+            return 429, _error('too-many-requests', 'Too many requests')
+        if failed:
+            return 500, _error('internal-error', 'Internal server error')
+        try:
+            data = json.loads(body.decode('utf-8'))
+            order_number = data['orderNumber']
+        except (ValueError, TypeError, KeyError):
+            order_number = None
+        if not order_number:
+            return 400, _error(
+                'invalid-order-number', 'Missing or invalid order number'
+            )
+
+        token = uuid.uuid4().hex
+        with self._lock:
+            self.payments[order_number] = data
+        return 201, {
+            'orderNumber': order_number,
+            'token': token,
+            'url': '%s/payment/load/token/%s' % (self.url, token)
+        }
+
+    def _authorization(self):
+        credentials = '%s:%s' % (self.merchant_id, self.merchant_secret)
+        return 'Basic ' + base64.b64encode(
+            credentials.encode('utf-8')
+        ).decode('ascii')
+
+    def _throttled(self):
+        if self.max_requests_per_second is None:
+            return False
+        second = int(time.time())
+        start, count = self._window
+        if start != second:
+            start, count = second, 0
+        self._window = (start, count + 1)
+        return count >= self.max_requests_per_second
+
+
+def _error(code, message):
+    return {'errorCode': code, 'errorMessage': message}
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Run a local stand-in for the Suomen Verkkomaksut API.'
+    )
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--merchant-id', default='13466')
+    parser.add_argument('--merchant-secret',
+                        default='6pKF4jkv97zmqBJ3ZL8gUw5DfT2NMQ')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='seconds to wait before each response')
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help='share of requests failing with status 500')
+    parser.add_argument('--max-requests-per-second', type=int, default=None,
+                        help='answer requests over this rate with status 429')
+    args = parser.parse_args(argv)
+
+    server = StubServer(
+        merchant_id=args.merchant_id,
+        merchant_secret=args.merchant_secret,
+        host=args.host,
+        port=args.port,
+        latency=args.latency,
+        error_rate=args.error_rate,
+        max_requests_per_second=args.max_requests_per_second
+    )
+    print('Serving on %s' % server.service_url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()